@@ -35,7 +35,7 @@ async def evaluate_script_handler(bot: Bot, message: Message, text: str):
 
 async def join_public_group_handler(bot: Bot, message: Message, text: str):
     logger.info('joining public group %s', text)
-    engine = await models.get_aio_engine()
+    engine = await models.get_aio_engine('admin')
     output = await discover.test_and_join_public_channel(engine, text)
     return str(output)
 
@@ -1,12 +1,50 @@
-import datetime
-from typing import Union
+import asyncio
+import socket
+from collections import OrderedDict, deque
+from hashlib import sha1
+from os import getpid
+from random import choices
+from time import monotonic, time as timestamp
+from logging import getLogger
+from typing import Union, List, Dict, Iterable, Callable, Awaitable, Optional
+from uuid import uuid4
 
 import aioredis
+import msgpack
 import config
 import utils
 
 
+logger = getLogger(__name__)
 AnyPrimitive = Union[str, int, float]
+INVALIDATE_CHANNEL = 'cache_invalidate'
+SINGLE_FLIGHT_CHANNEL = 'single_flight'
+
+
+def consumer_name() -> str:
+    """
+    Name of current process when consuming a queue, unique across hosts
+
+    :return: hostname-pid
+    """
+    return '{}-{}'.format(socket.gethostname(), getpid())
+
+
+class RedisScript:
+    """
+    Lua script, invoked by its digest and loaded on first use
+    """
+    def __init__(self, source: str):
+        self.source = source
+        self.sha = sha1(source.encode('utf-8')).hexdigest()
+
+    async def __call__(self, r: aioredis.Redis, keys: list = (), args: list = ()):
+        try:
+            return await r.evalsha(self.sha, keys=list(keys), args=list(args))
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+            return await r.eval(self.source, keys=list(keys), args=list(args))
 
 
 class RedisObject:
@@ -17,7 +55,7 @@ class RedisObject:
 
     @classmethod
     async def init(cls):
-        cls.r = await aioredis.create_redis_pool(address=config.REDIS_URL, minsize=1, maxsize=20)
+        cls.r = await aioredis.create_redis_pool(address=config.REDIS_URL, minsize=1, maxsize=config.REDIS_POOL_SIZE)
 
     async def delete(self):
         await self.r.delete(self.name)
@@ -40,48 +78,241 @@ class RedisExpiringValue(RedisObject):
         return (await self.r.get(self.name)).decode('utf-8')
 
 
+TOUCH_SCRIPT = RedisScript('''
+local saved = redis.call('ZSCORE', KEYS[1], ARGV[1])
+local now = tonumber(ARGV[2])
+if saved and tonumber(saved) + tonumber(ARGV[3]) > now then
+    redis.call('ZADD', KEYS[1], now, ARGV[1])
+    return 1
+end
+if ARGV[4] == '1' then
+    redis.call('ZADD', KEYS[1], now, ARGV[1])
+elseif saved then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return 0
+''')
+
+
+TOUCH_MANY_SCRIPT = RedisScript('''
+local now = tonumber(ARGV[1])
+local expire = tonumber(ARGV[2])
+local found = {}
+for i = 3, #ARGV do
+    local saved = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if saved and tonumber(saved) + expire > now then
+        found[#found + 1] = 1
+    else
+        found[#found + 1] = 0
+    end
+    redis.call('ZADD', KEYS[1], now, ARGV[i])
+end
+return found
+''')
+
+
 class RedisExpiringSet(RedisObject):
-    def __init__(self, name, expire):
+    """
+    Set with items expiring `expire` seconds after last seen
+
+    With `local_size` set, items confirmed in redis are remembered in process for `local_ttl` seconds
+    (least recently used ones are dropped first), hits in that period skip redis.
+
+    Expired items are removed by `sweeper`, which also evicts the oldest items over `max_size`.
+    """
+    registry = {}  # name -> set, for sweeper
+
+    def __init__(self, name, expire, local_size: int = 0, local_ttl: int = 60, max_size: int = 0):
         super().__init__(name)
         self.expire = expire
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self.local = OrderedDict()  # item -> timestamp confirmed
+        self.max_size = max_size
+        self.size = 0
+        self.expired = 0
+        self.evicted = 0
+        if name not in self.registry or max_size:
+            self.registry[name] = self
 
     async def repr(self) -> str:
         min_timestamp = utils.get_now_timestamp() - self.expire
         items = await self.r.zrangebyscore(self.name, min_timestamp, float('+inf'))
         return 'RedisExpiringSet%s' % (i.decode('utf-8') for i in items)
 
-    async def contains(self, item: str) -> bool:
-        saved = await self.r.zscore(self.name, item)
-        now = utils.get_now_timestamp()
+    def local_contains(self, item: str) -> bool:
+        if not self.local_size:
+            return False
+        confirmed = self.local.get(item)
+        if confirmed is None:
+            return False
+        if confirmed + self.local_ttl <= monotonic():
+            del self.local[item]
+            return False
+        self.local.move_to_end(item)
+        return True
 
-        # 1:30 + 1h, now 2:00, not expired
-        if saved and saved + self.expire > now:
-            await self.r.zadd(self.name, now, item)
+    def local_add(self, item: str):
+        if not self.local_size:
+            return
+        self.local[item] = monotonic()
+        self.local.move_to_end(item)
+        while len(self.local) > self.local_size:
+            self.local.popitem(last=False)
+
+    async def check(self, item: str, insert: bool) -> bool:
+        item = str(item)
+        if self.local_contains(item):
             return True
 
-        await self.r.zrem(self.name, item)
-        return False
+        # 1:30 + 1h, now 2:00, not expired
+        found = await TOUCH_SCRIPT(self.r, keys=[self.name],
+                                   args=[item, utils.get_now_timestamp(), self.expire, int(insert)])
+        if found or insert:
+            self.local_add(item)
+        return bool(found)
+
+    async def contains(self, item: str) -> bool:
+        """
+        Check if item is in set, and refresh its time if so
+        """
+        return await self.check(item, insert=False)
+
+    async def touch(self, item: str) -> bool:
+        """
+        Check if item is in set, and add or refresh it in the same round trip
+
+        :return: if item was in set before
+        """
+        return await self.check(item, insert=True)
+
+    async def touch_many(self, items: List[str]) -> List[bool]:
+        """
+        `touch` items in one round trip, local cache is not used
+
+        :return: if each item was in set before, later duplicates of an item are found
+        """
+        if not items:
+            return []
+        found = await TOUCH_MANY_SCRIPT(self.r, keys=[self.name],
+                                        args=[utils.get_now_timestamp(), self.expire] + list(items))
+        return [bool(i) for i in found]
 
     def __contains__(self, item) -> bool:
         return utils.block(self.contains(item))
 
     async def add(self, item: str):
         await self.r.zadd(self.name, utils.get_now_timestamp(), item)
+        self.local_add(str(item))
 
     async def discard(self, item: str):
+        self.local.pop(str(item), None)
         await self.r.zrem(self.name, item)
 
+    async def discard_many(self, items: List[str]):
+        if not items:
+            return
+        for item in items:
+            self.local.pop(str(item), None)
+        await self.r.zrem(self.name, *items)
+
     async def clear(self):
+        self.local.clear()
         await self.r.delete(self.name)
 
+    async def sweep(self):
+        pipe = self.r.pipeline()
+        pipe.zremrangebyscore(self.name, float('-inf'), utils.get_now_timestamp() - self.expire)
+        if self.max_size:
+            pipe.zremrangebyrank(self.name, 0, -self.max_size - 1)
+        pipe.zcard(self.name)
+        result = await pipe.execute()
+        self.expired = result[0]
+        self.evicted = result[1] if self.max_size else 0
+        self.size = result[-1]
+
+    @classmethod
+    async def sweeper(cls, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            for s in list(cls.registry.values()):
+                try:
+                    await s.sweep()
+                except aioredis.RedisError:
+                    utils.report_exception()
+
+    @classmethod
+    async def stat(cls):
+        return ''.join('{} set: size {}, expired {}, evicted {}\n'.format(s.name, s.size, s.expired, s.evicted)
+                       for s in cls.registry.values())
+
+
+MOVE_MANY_SCRIPT = RedisScript('''
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+''')
+
+
+ENVELOPE_VERSION = b'\x01'  # followed by msgpack
+
+
+def envelope_encode(value) -> bytes:
+    return ENVELOPE_VERSION + msgpack.packb(value, use_bin_type=True)
+
+
+def envelope_decode(raw: bytes):
+    if raw[:1] == ENVELOPE_VERSION:
+        return msgpack.unpackb(raw[1:], raw=False)
+    return utils.from_json(raw)  # queued before envelope is used
+
+
+def text_decode(raw):
+    if isinstance(raw, bytes):
+        return raw.decode('utf-8')
+    return raw
+
+
+CODECS = {  # name -> (encode, decode), items are read from redis as bytes
+    'raw': (lambda value: value, text_decode),
+    'json': (lambda value: utils.to_json(value), lambda raw: utils.from_json(raw)),
+    'envelope': (envelope_encode, envelope_decode),
+}
+queues = {}  # name -> queue of any backend
+
 
 class RedisQueue(RedisObject):
-    def __init__(self, name: str):
+    """
+    FIFO queue on a redis list
+
+    Reliable consumers use `pop`, which blocks on the queue and moves the item into a processing list owned by
+    this consumer until it is acknowledged with `ack` or given back with `requeue`. Items left in processing lists
+    of consumers that stopped sending heartbeats are moved back to the head of the queue by `reclaim`.
+
+    `keeper` sends heartbeats of every queue in the process, so slow handlers do not look dead, and reclaims
+    periodically, so items of crashed consumers are not left until the next restart.
+    """
+    heartbeat_interval = 10
+    registry = {}  # name -> queue, for keeper
+
+    def __init__(self, name: str, codec: str = 'raw'):
         super().__init__(name)
+        self.encode, self.decode = CODECS[codec]
+        self.consumer = consumer_name()
+        self.consumers = name + '_consumers'
+        self.processing = self.processing_name(self.consumer)
+        self.last_heartbeat = 0
+        self.registry[name] = self
+
+    def processing_name(self, consumer: str) -> str:
+        return '{}_processing_{}'.format(self.name, consumer)
 
     async def repr(self):
         items = await self.r.lrange(self.name, 0, -1)
-        return 'RedisQueue%s' % (i.decode('utf-8') for i in items)
+        return 'RedisQueue%s' % [self.decode(i) for i in items]
 
     async def qsize(self) -> int:
         return await self.r.llen(self.name)
@@ -89,44 +320,839 @@ class RedisQueue(RedisObject):
     async def task_done(self):
         pass
 
-    async def get(self) -> Union[str, None]:
-        val = await self.r.lpop(self.name)
-        if val is None:
+    async def get(self) -> Union[bytes, None]:
+        return await self.r.lpop(self.name)
+
+    async def get_many(self, count: int) -> List[bytes]:
+        return await self.r.execute(b'LPOP', self.name, count) or []
+
+    async def heartbeat(self):
+        now = utils.get_now_timestamp()
+        if now - self.last_heartbeat < self.heartbeat_interval:
             return
-        return val.decode('utf-8')
+        self.last_heartbeat = now
+        await self.r.zadd(self.consumers, now, self.consumer)
 
-    async def insert(self, value: AnyPrimitive):
-        await self.r.lpush(self.name, value)
+    async def pop(self, timeout: int = 1) -> Union[bytes, None]:
+        await self.heartbeat()
+        with await self.r as conn:  # blocking command needs a dedicated connection
+            return await conn.execute(b'BLMOVE', self.name, self.processing, b'LEFT', b'RIGHT', timeout)
 
-    async def put(self, value: AnyPrimitive):
-        await self.r.rpush(self.name, value)
+    async def pop_many(self, count: int, timeout: int = 1) -> List[bytes]:
+        first = await self.pop(timeout)
+        if first is None:
+            return []
+        if count <= 1:
+            return [first]
+        rest = await MOVE_MANY_SCRIPT(self.r, keys=[self.name, self.processing], args=[count - 1])
+        return [first] + rest
 
+    async def ack(self, value: AnyPrimitive):
+        await self.r.lrem(self.processing, 1, value)
 
-class RedisDict(RedisObject):
+    async def ack_many(self, values: Iterable[AnyPrimitive]):
+        pipe = self.r.pipeline()
+        for value in values:
+            pipe.lrem(self.processing, 1, value)
+        await pipe.execute()
+
+    async def requeue(self, value: AnyPrimitive):
+        await self.requeue_many([value])
+
+    async def requeue_many(self, values: List[AnyPrimitive]):
+        tr = self.r.multi_exec()
+        tr.rpush(self.name, *values)
+        for value in values:
+            tr.lrem(self.processing, 1, value)
+        await tr.execute()
+
+    async def reclaim(self) -> int:
+        """
+        Move in-flight items of stale consumers back to the head of queue
+
+        :return: count of items reclaimed
+        """
+        deadline = utils.get_now_timestamp() - config.QUEUE_CONSUMER_TIMEOUT
+        count = 0
+        for consumer in await self.r.zrangebyscore(self.consumers, float('-inf'), deadline):
+            consumer = consumer.decode('utf-8')
+            if consumer == self.consumer:
+                continue
+            processing = self.processing_name(consumer)
+            while await self.r.execute(b'LMOVE', processing, self.name, b'RIGHT', b'LEFT') is not None:
+                count += 1
+            await self.r.zrem(self.consumers, consumer)
+        return count
+
+    @classmethod
+    async def keeper(cls, interval: int):
+        """
+        Send heartbeats every `interval` seconds, and reclaim every half `QUEUE_CONSUMER_TIMEOUT`
+        """
+        last_reclaim = 0
+        while True:
+            now = utils.get_now_timestamp()
+            reclaim = now - last_reclaim >= config.QUEUE_CONSUMER_TIMEOUT / 2
+            for queue in list(cls.registry.values()):
+                try:
+                    await queue.heartbeat()
+                    if reclaim:
+                        count = await queue.reclaim()
+                        if count:
+                            logger.warning('%s: %s items of stale consumers reclaimed', queue.name, count)
+                except aioredis.RedisError:
+                    utils.report_exception()
+            if reclaim:
+                last_reclaim = now
+            await asyncio.sleep(interval)
+
+    async def insert(self, value):
+        await self.r.lpush(self.name, self.encode(value))
+
+    async def put(self, value):
+        await self.r.rpush(self.name, self.encode(value))
+
+    async def put_many(self, values: list):
+        if values:
+            await self.r.rpush(self.name, *(self.encode(value) for value in values))
+
+
+class MemoryQueue:
+    """
+    Queue in process memory with the same interface as `RedisQueue`, objects are passed without serialization.
+    Nothing is in flight: ack does nothing, and items are lost with the process.
+    """
     def __init__(self, name: str):
+        self.name = name
+        self.items = deque()
+        self.waiters = deque()  # futures of blocked pops
+
+    def __len__(self):
+        return len(self.items)
+
+    @staticmethod
+    def decode(value):
+        return value
+
+    def take(self, count: int) -> list:
+        items = []
+        while self.items and len(items) < count:
+            items.append(self.items.popleft())
+        return items
+
+    def wake(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def repr(self):
+        return 'MemoryQueue%s' % list(self.items)
+
+    async def delete(self):
+        self.items.clear()
+
+    async def qsize(self) -> int:
+        return len(self.items)
+
+    async def task_done(self):
+        pass
+
+    async def get(self):
+        items = self.take(1)
+        return items[0] if items else None
+
+    async def get_many(self, count: int) -> list:
+        return self.take(count)
+
+    async def pop(self, timeout: float = 1):
+        if not self.items:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+        return await self.get()
+
+    async def pop_many(self, count: int, timeout: float = 1) -> list:
+        first = await self.pop(timeout)
+        if first is None:
+            return []
+        return [first] + self.take(count - 1)
+
+    async def ack(self, value):
+        pass
+
+    async def ack_many(self, values):
+        pass
+
+    async def requeue(self, value):
+        await self.put(value)
+
+    async def requeue_many(self, values: list):
+        await self.put_many(values)
+
+    async def reclaim(self) -> int:
+        return 0
+
+    async def insert(self, value):
+        self.items.appendleft(value)
+        self.wake()
+
+    async def put(self, value):
+        self.items.append(value)
+        self.wake()
+
+    async def put_many(self, values: list):
+        for value in values:
+            await self.put(value)
+
+
+class LocalItem:
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+
+class HybridQueue(RedisQueue):
+    """
+    Items are kept in process memory, and spilled to redis when there are `threshold` items in memory already.
+    Consumers take items in memory first, so the order is roughly FIFO only.
+    Items put into redis by other processes are noticed by a blocked consumer after `timeout` at most.
+    """
+    def __init__(self, name: str, codec: str = 'raw', threshold: int = 10000):
+        super().__init__(name, codec)
+        self.local = MemoryQueue(name)
+        self.threshold = threshold
+        self.decode_remote = self.decode
+        self.decode = self.decode_item
+
+    def decode_item(self, raw):
+        if isinstance(raw, LocalItem):
+            return raw.value
+        return self.decode_remote(raw)
+
+    async def repr(self):
+        return 'HybridQueue(%s, %s)' % (await self.local.repr(), await super().repr())
+
+    async def qsize(self) -> int:
+        return len(self.local) + await super().qsize()
+
+    async def get(self):
+        item = await self.local.get()
+        if item is not None:
+            return item
+        return await super().get()
+
+    async def get_many(self, count: int) -> list:
+        items = self.local.take(count)
+        if len(items) < count:
+            items += await super().get_many(count - len(items))
+        return items
+
+    async def pop(self, timeout: float = 1):
+        items = await self.pop_many(1, timeout)
+        return items[0] if items else None
+
+    async def pop_many(self, count: int, timeout: float = 1) -> list:
+        await self.heartbeat()
+        items = self.local.take(count)
+        if len(items) < count:
+            rest = await MOVE_MANY_SCRIPT(self.r, keys=[self.name, self.processing], args=[count - len(items)])
+            items += rest
+        if items:
+            return items
+        return await self.local.pop_many(count, timeout)
+
+    async def ack_many(self, values):
+        remote = [value for value in values if not isinstance(value, LocalItem)]
+        if remote:
+            await super().ack_many(remote)
+
+    async def ack(self, value):
+        await self.ack_many([value])
+
+    async def requeue_many(self, values: list):
+        await self.local.put_many([value for value in values if isinstance(value, LocalItem)])
+        remote = [value for value in values if not isinstance(value, LocalItem)]
+        if remote:
+            await super().requeue_many(remote)
+
+    async def insert(self, value):
+        await self.local.insert(LocalItem(value))
+
+    async def put(self, value):
+        if len(self.local) < self.threshold:
+            await self.local.put(LocalItem(value))
+        else:
+            await super().put(value)
+
+    async def put_many(self, values: list):
+        for value in values:
+            await self.put(value)
+
+
+class StreamItem(bytes):
+    """
+    Item read from a stream, remembering its entry id for acknowledgement
+    """
+    entry_id = None  # type: bytes
+
+
+class RedisStreamQueue(RedisObject):
+    """
+    Queue on a redis stream with one consumer group, each process is a consumer named by host and pid.
+
+    Items read stay in the pending list of the consumer until acknowledged. Consumers send heartbeats like
+    `RedisQueue`, items pending in consumers silent for `QUEUE_CONSUMER_TIMEOUT` are claimed by `reclaim` and added
+    to the stream again, however long they are handled by live ones. The stream is trimmed to about `maxlen` entries.
+    """
+    group = 'workers'
+    heartbeat_interval = RedisQueue.heartbeat_interval
+
+    def __init__(self, name: str, codec: str = 'raw', maxlen: int = 1000000):
+        super().__init__(name)
+        self.encode, self.decode = CODECS[codec]
+        self.consumer = consumer_name()
+        self.consumers = name + '_consumers'
+        self.maxlen = maxlen
+        self.group_created = False
+        self.last_reclaim = utils.get_now_timestamp()
+        self.last_heartbeat = 0
+        RedisQueue.registry[name] = self  # heartbeats and reclaim by keeper
+
+    async def create_group(self):
+        if self.group_created:
+            return
+        try:
+            await self.r.execute(b'XGROUP', b'CREATE', self.name, self.group, b'0', b'MKSTREAM')
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+        self.group_created = True
+
+    @staticmethod
+    def items(entries) -> List[StreamItem]:
+        items = []
+        for entry in entries or ():
+            if entry is None:  # deleted by trimming
+                continue
+            entry_id, fields = entry
+            item = StreamItem(fields[1])
+            item.entry_id = entry_id
+            items.append(item)
+        return items
+
+    async def repr(self):
+        return 'RedisStreamQueue(%s, pending %s)' % (self.name, await self.pending())
+
+    async def pending(self) -> dict:
+        """
+        :return: consumer -> count of items in its pending list
+        """
+        await self.create_group()
+        summary = await self.r.execute(b'XPENDING', self.name, self.group)
+        return {consumer.decode('utf-8'): int(count) for consumer, count in summary[3] or ()}
+
+    async def qsize(self) -> int:
+        """
+        :return: count of items not acknowledged yet
+        """
+        await self.create_group()
+        for info in await self.r.execute(b'XINFO', b'GROUPS', self.name):
+            info = dict(zip(info[::2], info[1::2]))
+            if info[b'name'].decode('utf-8') != self.group:
+                continue
+            if info.get(b'lag') is not None:
+                return info[b'lag'] + info[b'pending']
+        return await self.r.execute(b'XLEN', self.name)
+
+    async def task_done(self):
+        pass
+
+    async def read(self, count: int, block: int = None, noack: bool = False) -> List[StreamItem]:
+        await self.create_group()
+        args = [b'GROUP', self.group, self.consumer, b'COUNT', count]
+        if block is not None:
+            args += [b'BLOCK', block]
+        if noack:
+            args += [b'NOACK']
+        args += [b'STREAMS', self.name, b'>']
+        if block is None:
+            result = await self.r.execute(b'XREADGROUP', *args)
+        else:
+            with await self.r as conn:  # blocking command needs a dedicated connection
+                result = await conn.execute(b'XREADGROUP', *args)
+        if not result:
+            return []
+        return self.items(result[0][1])
+
+    async def get(self) -> Union[bytes, None]:
+        items = await self.read(1, noack=True)
+        return items[0] if items else None
+
+    async def get_many(self, count: int) -> List[bytes]:
+        return await self.read(count, noack=True)
+
+    async def pop(self, timeout: float = 1) -> Union[bytes, None]:
+        items = await self.pop_many(1, timeout)
+        return items[0] if items else None
+
+    async def heartbeat(self):
+        now = utils.get_now_timestamp()
+        if now - self.last_heartbeat < self.heartbeat_interval:
+            return
+        self.last_heartbeat = now
+        await self.r.zadd(self.consumers, now, self.consumer)
+
+    async def pop_many(self, count: int, timeout: float = 1) -> List[bytes]:
+        await self.heartbeat()
+        if utils.get_now_timestamp() - self.last_reclaim > config.QUEUE_CONSUMER_TIMEOUT:
+            await self.reclaim()
+        return await self.read(count, block=max(1, int(timeout * 1000)))
+
+    async def ack(self, value: StreamItem):
+        await self.ack_many([value])
+
+    async def ack_many(self, values: Iterable[StreamItem]):
+        entry_ids = [value.entry_id for value in values]
+        if entry_ids:
+            await self.r.execute(b'XACK', self.name, self.group, *entry_ids)
+
+    async def requeue(self, value: StreamItem):
+        await self.requeue_many([value])
+
+    async def requeue_many(self, values: List[StreamItem]):
+        tr = self.r.multi_exec()
+        for value in values:
+            tr.xadd(self.name, {b'v': value}, max_len=self.maxlen)
+        tr.xack(self.name, self.group, *(value.entry_id for value in values))
+        await tr.execute()
+
+    async def reclaim(self) -> int:
+        """
+        Add items pending in consumers without heartbeats for `QUEUE_CONSUMER_TIMEOUT` to the stream again
+
+        :return: count of items reclaimed
+        """
+        await self.create_group()
+        self.last_reclaim = utils.get_now_timestamp()
+        deadline = self.last_reclaim - config.QUEUE_CONSUMER_TIMEOUT
+        alive = {consumer.decode('utf-8')
+                 for consumer in await self.r.zrangebyscore(self.consumers, deadline, float('inf'))}
+        count = 0
+        for consumer in await self.pending():
+            if consumer == self.consumer or consumer in alive:
+                continue
+            while True:
+                entries = await self.r.execute(b'XPENDING', self.name, self.group, b'-', b'+', 100, consumer)
+                if not entries:
+                    break
+                entry_ids = [entry[0] for entry in entries]
+                items = self.items(await self.r.execute(b'XCLAIM', self.name, self.group, self.consumer, 0,
+                                                        *entry_ids))
+                if items:
+                    await self.requeue_many(items)
+                    count += len(items)
+                trimmed = set(entry_ids) - {item.entry_id for item in items}
+                if trimmed:  # nothing to add again, but they would stay pending
+                    await self.r.execute(b'XACK', self.name, self.group, *trimmed)
+            await self.r.execute(b'XGROUP', b'DELCONSUMER', self.name, self.group, consumer)
+            await self.r.zrem(self.consumers, consumer)
+        return count
+
+    async def insert(self, value):
+        await self.put(value)
+
+    async def put(self, value):
+        await self.r.xadd(self.name, {b'v': self.encode(value)}, max_len=self.maxlen)
+
+    async def put_many(self, values: list):
+        pipe = self.r.pipeline()
+        for value in values:
+            pipe.xadd(self.name, {b'v': self.encode(value)}, max_len=self.maxlen)
+        await pipe.execute()
+
+
+class LaneItem:
+    __slots__ = ('lane', 'value')
+
+    def __init__(self, lane, value):
+        self.lane = lane
+        self.value = value
+
+
+class LaneQueue:
+    """
+    Queues (lanes) consumed together, with the same interface as `RedisQueue`. Without `weights` lanes are taken
+    by strict priority in their order, otherwise a non-empty lane is picked at random by weight.
+    Items are put into the first lane, other lanes are filled through `lane(name)`.
+    """
+    def __init__(self, name: str, lanes: Dict[str, object], weights: Optional[Dict[str, int]] = None):
+        self.name = name
+        self.lanes = lanes  # lane name -> queue, highest priority first
+        self.weights = weights
+        self.first = next(iter(lanes.values()))
+
+    def lane(self, name: str):
+        return self.lanes[name]
+
+    @staticmethod
+    def decode(item: LaneItem):
+        return item.lane.decode(item.value)
+
+    async def repr(self):
+        return 'LaneQueue(%s)' % ', '.join([await lane.repr() for lane in self.lanes.values()])
+
+    async def sizes(self) -> Dict[str, int]:
+        return {name: await lane.qsize() for name, lane in self.lanes.items()}
+
+    async def qsize(self) -> int:
+        return sum((await self.sizes()).values())
+
+    async def task_done(self):
+        for lane in self.lanes.values():
+            await lane.task_done()
+
+    async def order(self) -> list:
+        """
+        :return: non-empty lanes in the order to be tried
+        """
+        sizes = await self.sizes()
+        names = [name for name, size in sizes.items() if size]
+        if self.weights and len(names) > 1:
+            first, = choices(names, [self.weights.get(name, 1) for name in names])
+            names.remove(first)
+            names.insert(0, first)
+        return [self.lanes[name] for name in names]
+
+    @staticmethod
+    def wrap(lane, items: list) -> List[LaneItem]:
+        return [LaneItem(lane, item) for item in items]
+
+    async def get_many(self, count: int) -> List[LaneItem]:
+        for lane in await self.order():
+            items = await lane.get_many(count)
+            if items:
+                return self.wrap(lane, items)
+        return []
+
+    async def pop_many(self, count: int, timeout: float = 1) -> List[LaneItem]:
+        for lane in await self.order():
+            items = await lane.pop_many(count, timeout)
+            if items:
+                return self.wrap(lane, items)
+        # all empty, wait for the first lane
+        return self.wrap(self.first, await self.first.pop_many(count, timeout))
+
+    def group(self, items: Iterable[LaneItem]) -> dict:
+        groups = {}  # lane -> values
+        for item in items:
+            groups.setdefault(item.lane, []).append(item.value)
+        return groups
+
+    async def ack_many(self, items: Iterable[LaneItem]):
+        for lane, values in self.group(items).items():
+            await lane.ack_many(values)
+
+    async def requeue_many(self, items: List[LaneItem]):
+        for lane, values in self.group(items).items():
+            await lane.requeue_many(values)
+
+    async def reclaim(self) -> int:
+        return sum([await lane.reclaim() for lane in self.lanes.values()])
+
+    async def put(self, value):
+        await self.first.put(value)
+
+    async def put_many(self, values: list):
+        await self.first.put_many(values)
+
+
+def new_queue(name: str, codec: str, backend: str):
+    if backend == 'memory':
+        return MemoryQueue(name)
+    elif backend == 'hybrid':
+        return HybridQueue(name, codec, config.HYBRID_QUEUE_THRESHOLD)
+    elif backend == 'stream':
+        return RedisStreamQueue(name, codec, config.STREAM_QUEUE_MAXLEN)
+    return RedisQueue(name, codec)
+
+
+def make_queue(name: str, codec: str = 'raw', backend: str = 'redis', lanes: List[str] = (),
+               weights: Optional[Dict[str, int]] = None):
+    """
+    Get the queue `name` in this process
+
+    :param codec: serialization of items in redis, 'raw' for strings as is or 'json'
+    :param backend: 'redis', 'memory', 'hybrid' or 'stream'
+    :param lanes: names of lanes by priority, the first one is stored as `name` and others as `name_lane`
+    :param weights: lane name -> weight, see `LaneQueue`
+    """
+    if name not in queues:
+        if lanes:
+            queues[name] = LaneQueue(name, {
+                lane: new_queue(name if i == 0 else '{}_{}'.format(name, lane), codec, backend)
+                for i, lane in enumerate(lanes)
+            }, weights)
+            for lane in list(queues[name].lanes.values())[1:]:  # found by name for delayed items
+                queues[lane.name] = lane
+        else:
+            queues[name] = new_queue(name, codec, backend)
+    return queues[name]
+
+
+DELAYED_POP_SCRIPT = RedisScript('''
+local entries = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, entry in ipairs(entries) do
+    redis.call('ZADD', KEYS[1], ARGV[3], entry)
+end
+return entries
+''')
+
+
+class RedisDelayedQueue(RedisObject):
+    """
+    Items due at a time, in sorted set `name` by due timestamp. `mover` puts due items into their queues found by
+    name in this process, re-encoded by the queue. Failures of an item are counted under `name_attempts:` keys
+    by hash of the item, expiring `attempts_ttl` seconds after the last one.
+
+    Due items are leased for `lease` seconds and removed only after they are put, so items of a mover that
+    crashed in between, or of queues unknown to this process, are due again later instead of lost.
+    """
+    lease = 60
+
+    def __init__(self, name: str, attempts_ttl: int = 86400):
         super().__init__(name)
+        self.attempts_ttl = attempts_ttl
+
+    @staticmethod
+    def digest(queue_name: str, value) -> str:
+        return sha1(queue_name.encode('utf-8') + envelope_encode(value)).hexdigest()
+
+    def attempts_key(self, queue_name: str, value) -> str:
+        return '{}_attempts:{}'.format(self.name, self.digest(queue_name, value))
+
+    async def qsize(self) -> int:
+        return await self.r.zcard(self.name)
+
+    async def put_many(self, queue_name: str, values: list, delays: List[float]):
+        """
+        :param delays: seconds to wait for each item
+        """
+        if not values:
+            return
+        now = timestamp()
+        pairs = []
+        for value, delay in zip(values, delays):
+            pairs += [now + delay, envelope_encode(dict(q=queue_name, v=value, id=uuid4().hex))]
+        await self.r.zadd(self.name, *pairs)
+
+    async def put(self, queue_name: str, value, delay: float):
+        await self.put_many(queue_name, [value], [delay])
+
+    async def attempt(self, queue_name: str, values: list) -> List[int]:
+        """
+        Count a failure of each item
+
+        :return: failures of each item so far
+        """
+        pipe = self.r.pipeline()
+        for value in values:
+            key = self.attempts_key(queue_name, value)
+            pipe.incr(key)
+            pipe.expire(key, self.attempts_ttl)
+        results = await pipe.execute()
+        return results[::2]
+
+    async def forget(self, queue_name: str, values: list):
+        if values:
+            await self.r.delete(*(self.attempts_key(queue_name, value) for value in values))
+
+    async def move_due(self, count: int = 100) -> int:
+        """
+        :return: count of items moved
+        """
+        now = timestamp()
+        entries = await DELAYED_POP_SCRIPT(self.r, keys=[self.name], args=[now, count, now + self.lease])
+        groups = {}  # queue name -> (raw entries, items)
+        for raw in entries:
+            entry = envelope_decode(raw)
+            group = groups.setdefault(entry['q'], ([], []))
+            group[0].append(raw)
+            group[1].append(entry['v'])
+        moved = 0
+        for queue_name, (raws, values) in groups.items():
+            if queue_name not in queues:
+                logger.warning('delayed items of unknown queue %s kept for %s seconds: %s',
+                               queue_name, self.lease, values)
+                continue
+            await queues[queue_name].put_many(values)
+            await self.r.zrem(self.name, *raws)
+            moved += len(raws)
+        return moved
+
+    async def mover(self, interval: float = 1, count: int = 100):
+        while True:
+            try:
+                if await self.move_due(count) < count:
+                    await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                break
+            except aioredis.RedisError:
+                utils.report_exception()
+                await asyncio.sleep(interval)
+
+
+class RedisDeadLetters(RedisObject):
+    """
+    Items failed too many times in list `queue name + _dead`, oldest first, kept for inspection and replay
+    """
+    def __init__(self, queue_name: str):
+        super().__init__(queue_name + '_dead')
+        self.queue_name = queue_name
+
+    async def qsize(self) -> int:
+        return await self.r.llen(self.name)
+
+    async def push_many(self, values: list, error: str, attempts: List[int]):
+        if values:
+            now = utils.get_now_timestamp()
+            await self.r.rpush(self.name, *(envelope_encode(dict(v=value, error=error, attempts=n, time=now))
+                                             for value, n in zip(values, attempts)))
+
+    async def peek(self, count: int) -> List[dict]:
+        """
+        :return: oldest entries, with item `v`, last `error`, `attempts` and `time` failed
+        """
+        return [envelope_decode(entry) for entry in await self.r.lrange(self.name, 0, count - 1)]
+
+    async def replay(self, count: int) -> int:
+        """
+        Move oldest items back to their queue
+
+        :return: count of items replayed
+        """
+        entries = await self.r.execute(b'LPOP', self.name, count) or []
+        values = [envelope_decode(entry)['v'] for entry in entries]
+        if values:
+            await queues[self.queue_name].put_many(values)
+        return len(values)
+
+
+POP_ALL_SCRIPT = RedisScript('''
+local items = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return items
+''')
+
+
+class RedisDict(RedisObject):
+    """
+    Hash in redis
+
+    With `local_ttl` set, values read are cached in process for `local_ttl` seconds. Writes through any cached
+    instance are published to `INVALIDATE_CHANNEL`, so cached copies of the key in all processes are dropped.
+    """
+    cached = {}  # name -> cached instances, for invalidation
+
+    def __init__(self, name: str, local_ttl: int = 0):
+        super().__init__(name)
+        self.local_ttl = local_ttl
+        self.local = {}  # key -> (value, expire at)
+        self.local_items = None  # (items, expire at)
+        self.version = 0  # bumped by invalidation, values fetched before that are not cached
+        if local_ttl:
+            self.cached.setdefault(name, []).append(self)
+
+    def invalidate(self, *keys: str):
+        self.version += 1
+        self.local_items = None
+        if not keys:
+            self.local.clear()
+        for key in keys:
+            self.local.pop(str(key), None)
+
+    @classmethod
+    async def listen(cls):
+        """
+        Drop local values written by other processes
+        """
+        while True:
+            try:
+                channel, = await cls.r.subscribe(INVALIDATE_CHANNEL)
+                while await channel.wait_message():
+                    name, key = (await channel.get()).decode('utf-8').split('\n', maxsplit=1)
+                    for d in cls.cached.get(name, ()):
+                        if key:
+                            d.invalidate(key)
+                        else:
+                            d.invalidate()
+            except aioredis.RedisError:
+                utils.report_exception()
+            for instances in cls.cached.values():  # invalidations may be missed during reconnection
+                for d in instances:
+                    d.invalidate()
+            await asyncio.sleep(1)
+
+    async def write(self, keys: list, command):
+        """
+        :param keys: keys changed, invalidated everywhere if cached
+        :param command: function adding write commands to a pipeline
+        """
+        pipe = self.r.pipeline()
+        command(pipe)
+        if self.local_ttl:
+            self.invalidate(*keys)
+            for key in keys or ['']:
+                pipe.publish(INVALIDATE_CHANNEL, '{}\n{}'.format(self.name, key))
+        await pipe.execute()
 
     async def repr(self):
         d = await self.r.hgetall(self.name)
         return 'RedisDict%s' % {k.decode('utf-8'): v.decode('utf-8') for k, v in d.items()}
 
     async def getitem(self, key: str) -> Union[str, None]:
+        if self.local_ttl:
+            cached = self.local.get(str(key))
+            if cached and cached[1] > monotonic():
+                return cached[0]
+            version = self.version
+
         val = await self.r.hget(self.name, key)
-        if val is None:
-            return
-        return val.decode('utf-8')
+        if val is not None:
+            val = val.decode('utf-8')
+
+        if self.local_ttl and version == self.version:
+            self.local[str(key)] = (val, monotonic() + self.local_ttl)
+        return val
 
     def __getitem__(self, key: str):
         return self.getitem(key)
 
     async def set(self, key: str, value: AnyPrimitive):
-        await self.r.hset(self.name, key, value)
+        await self.write([key], lambda pipe: pipe.hset(self.name, key, value))
+
+    async def update(self, mapping: dict):
+        await self.write(list(mapping.keys()), lambda pipe: pipe.hmset_dict(self.name, mapping))
+
+    async def setnx(self, key: str, value: AnyPrimitive) -> bool:
+        """
+        :return: True if set, False if the key exists already
+        """
+        done = bool(await self.r.hsetnx(self.name, key, value))
+        if done and self.local_ttl:
+            await self.write([key], lambda pipe: None)  # invalidation only
+        return done
 
     def __setitem__(self, key: str, value: str):
         utils.block(self.set(key, value))
 
     async def delitem(self, key: str):
-        await self.r.hdel(self.name, key)
+        await self.write([key], lambda pipe: pipe.hdel(self.name, key))
 
     def __delitem__(self, key: str):
         utils.block(self.delitem(key))
@@ -138,34 +1164,275 @@ class RedisDict(RedisObject):
         return val
 
     async def incrby(self, key: str, val: int):
-        await self.r.hincrby(self.name, key, val)
+        await self.write([key], lambda pipe: pipe.hincrby(self.name, key, val))
+
+    async def pop_all(self):
+        """
+        Get all items and delete the hash atomically
+        """
+        values = await POP_ALL_SCRIPT(self.r, keys=[self.name])
+        return ((values[i].decode('utf-8'), values[i + 1].decode('utf-8')) for i in range(0, len(values), 2))
+
+    async def incrby_many(self, mapping: dict):
+        def command(pipe):
+            for key, val in mapping.items():
+                pipe.hincrby(self.name, key, val)
+
+        await self.write(list(mapping.keys()), command)
 
     async def items(self):
+        if self.local_ttl:
+            if self.local_items and self.local_items[1] > monotonic():
+                return iter(self.local_items[0])
+            version = self.version
+
         d = await self.r.hgetall(self.name)
-        return ((k.decode('utf-8'), v.decode('utf-8')) for k, v in d.items())
+        items = [(k.decode('utf-8'), v.decode('utf-8')) for k, v in d.items()]
 
+        if self.local_ttl and version == self.version:
+            self.local_items = (items, monotonic() + self.local_ttl)
+        return iter(items)
 
-class RedisDailyDict(RedisDict):
-    def __init__(self, name):
-        self.real_name = name
-        super().__init__(self.today_prefix + self.real_name)
-
-    @property
-    def today_prefix(self):
-        today = datetime.datetime.now()
-        return today.strftime('%Y-%m-%d-')
-
-    async def refresh(self):
-        today = datetime.datetime.now()
-        if today.hour == 0:
-            yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
-            await self.r.delete(yesterday.strftime('%Y-%m-%d-') + self.real_name)
-            self.name = today.strftime('%Y-%m-%d-') + self.real_name
-
-    async def getitem(self, key: str):
-        await self.refresh()
-        return await super().getitem(key)
-
-    async def set(self, key: str, value: str):
-        await self.refresh()
-        return await super().set(key, value)
+
+PENDING_ADD_SCRIPT = RedisScript('''
+for i, key in ipairs(KEYS) do
+    local flag = bit.bor(tonumber(redis.call('GET', key) or 0), tonumber(ARGV[1]))
+    redis.call('SET', key, flag, 'EX', ARGV[2])
+end
+''')
+
+PENDING_POP_SCRIPT = RedisScript('''
+local flags = redis.call('MGET', unpack(KEYS))
+redis.call('DEL', unpack(KEYS))
+for i = 1, #flags do
+    flags[i] = tonumber(flags[i] or 0)
+end
+return flags
+''')
+
+
+class RedisPendingFlags(RedisObject):
+    """
+    Bit flags waiting for items not existing yet, under `name:key` expiring `ttl` seconds after last change
+    """
+    def __init__(self, name: str, ttl: int):
+        super().__init__(name)
+        self.ttl = ttl
+
+    def key(self, key: str) -> str:
+        return '{}:{}'.format(self.name, key)
+
+    async def add(self, keys: List[str], flag: int):
+        if keys:
+            await PENDING_ADD_SCRIPT(self.r, keys=[self.key(key) for key in keys], args=[flag, self.ttl])
+
+    async def pop_many(self, keys: List[str]) -> List[int]:
+        """
+        :return: flags of each key, 0 if none
+        """
+        if not keys:
+            return []
+        return await PENDING_POP_SCRIPT(self.r, keys=[self.key(key) for key in keys])
+
+    async def discard(self, keys: List[str]):
+        if keys:
+            await self.r.delete(*(self.key(key) for key in keys))
+
+
+class MemoryDict:
+    """
+    Dict in process memory with the same interface as `RedisDict`, values are kept as strings like redis
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.data = {}
+
+    def invalidate(self, *keys: str):
+        pass
+
+    async def repr(self):
+        return 'MemoryDict%s' % self.data
+
+    async def delete(self):
+        self.data.clear()
+
+    async def getitem(self, key: str) -> Union[str, None]:
+        return self.data.get(str(key))
+
+    def __getitem__(self, key: str):
+        return self.getitem(key)
+
+    async def set(self, key: str, value: AnyPrimitive):
+        self.data[str(key)] = str(value)
+
+    async def update(self, mapping: dict):
+        for key, value in mapping.items():
+            await self.set(key, value)
+
+    async def setnx(self, key: str, value: AnyPrimitive) -> bool:
+        if str(key) in self.data:
+            return False
+        self.data[str(key)] = str(value)
+        return True
+
+    def __setitem__(self, key: str, value: str):
+        self.data[str(key)] = str(value)
+
+    async def delitem(self, key: str):
+        self.data.pop(str(key), None)
+
+    def __delitem__(self, key: str):
+        self.data.pop(str(key), None)
+
+    async def get(self, key: str, default: str):
+        val = await self.getitem(key)
+        if val is None:
+            val = default
+        return val
+
+    async def incrby(self, key: str, val: int):
+        self.data[str(key)] = str(int(self.data.get(str(key), 0)) + val)
+
+    async def incrby_many(self, mapping: dict):
+        for key, val in mapping.items():
+            await self.incrby(key, val)
+
+    async def pop_all(self):
+        items, self.data = self.data, {}
+        return iter(items.items())
+
+    async def items(self):
+        return iter(list(self.data.items()))
+
+
+dicts = {}  # name -> dict of any backend
+
+
+def make_dict(name: str, backend: str = 'redis'):
+    """
+    Get the dict `name` in this process
+
+    :param backend: 'redis' or 'memory', 'hybrid' is stored in redis
+    """
+    if name not in dicts:
+        if backend == 'memory':
+            dicts[name] = MemoryDict(name)
+        else:
+            dicts[name] = RedisDict(name)
+    return dicts[name]
+
+
+LEASE_RELEASE_SCRIPT = RedisScript('''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+''')
+
+
+class RedisSingleFlight(RedisObject):
+    """
+    Computes a value once for callers in all processes. The holder of lease `name:key` computes it and publishes
+    it to `SINGLE_FLIGHT_CHANNEL`, others wait for that, or take over when the lease expires after `ttl` seconds.
+    """
+    instances = {}  # name -> instance, for listen
+    poll_interval = 5  # max seconds waiting without checking the lease, in case the result is missed
+
+    def __init__(self, name: str, ttl: int):
+        super().__init__(name)
+        self.ttl = ttl
+        self.waiters = {}  # key -> futures waiting in this process
+        self.instances[name] = self
+
+    def key(self, key: str) -> str:
+        return '{}:{}'.format(self.name, key)
+
+    async def run(self, key: str, compute: Callable[[], Awaitable[str]], lookup: Callable[[], Awaitable[str]]) -> str:
+        """
+        :param compute: computes and stores the value, called with the lease held
+        :param lookup: finds the value stored before, None if not found
+        :return: value computed by any process
+        """
+        loop = asyncio.get_event_loop()
+        token = uuid4().hex
+        while True:
+            waiter = loop.create_future()  # registered before lookup, so a value published after it is not missed
+            self.waiters.setdefault(key, []).append(waiter)
+            try:
+                value = await lookup()
+                if value is not None:
+                    return value
+
+                if await self.r.set(self.key(key), token, expire=self.ttl, exist=self.r.SET_IF_NOT_EXIST):
+                    try:
+                        value = await compute()
+                        await self.r.publish(SINGLE_FLIGHT_CHANNEL, '{}\n{}\n{}'.format(self.name, key, value))
+                        return value
+                    finally:
+                        await LEASE_RELEASE_SCRIPT(self.r, keys=[self.key(key)], args=[token])
+
+                remaining = await self.r.pttl(self.key(key))  # negative when released just now
+                try:
+                    return await asyncio.wait_for(waiter, min(max(remaining, 0) / 1000, self.poll_interval))
+                except asyncio.TimeoutError:
+                    continue
+            finally:
+                waiters = self.waiters[key]
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[key]
+
+    def resolve(self, key: str, value: str):
+        for waiter in self.waiters.get(key, ()):
+            if not waiter.done():
+                waiter.set_result(value)
+
+    @classmethod
+    async def listen(cls):
+        """
+        Wake up waiters with values computed by other processes
+        """
+        while True:
+            try:
+                channel, = await cls.r.subscribe(SINGLE_FLIGHT_CHANNEL)
+                while await channel.wait_message():
+                    name, key, value = (await channel.get()).decode('utf-8').split('\n', maxsplit=2)
+                    if name in cls.instances:
+                        cls.instances[name].resolve(key, value)
+            except aioredis.RedisError:
+                utils.report_exception()
+            await asyncio.sleep(1)
+
+
+class RedisTTLCache(RedisObject):
+    """
+    String values under `name:key`, each expiring `ttl` seconds after set
+    """
+    def __init__(self, name: str, ttl: int):
+        super().__init__(name)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, key: str) -> str:
+        return '{}:{}'.format(self.name, key)
+
+    async def repr(self):
+        return 'RedisTTLCache({}, ttl={}, hits={}, misses={})'.format(self.name, self.ttl, self.hits, self.misses)
+
+    async def get(self, key: str) -> Union[str, None]:
+        val = await self.r.get(self.key(key))
+        if val is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        return val.decode('utf-8')
+
+    async def set(self, value: AnyPrimitive, *keys: str, ttl: int = 0):
+        pipe = self.r.pipeline()
+        for key in keys:
+            pipe.set(self.key(key), value, expire=ttl or self.ttl)
+        await pipe.execute()
+
+    async def discard(self, *keys: str):
+        await self.r.delete(*(self.key(key) for key in keys))
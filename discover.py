@@ -40,7 +40,8 @@ def extract_uid_gid_from_link(link: str):
 PUBLIC_REGEX = re.compile(r"t(?:elegram)?\.me/([a-zA-Z][\w\d]{3,30}[a-zA-Z\d])")
 PUBLIC_AT_REGEX = re.compile(r"@([a-zA-Z][\w\d]{3,30}[a-zA-Z\d])")
 INVITE_REGEX = re.compile(r'(t(?:elegram)?\.me/joinchat/[a-zA-Z0-9_-]{22})')
-recent_found_links = cache.RedisExpiringSet('recent_found_links', expire=86400)
+recent_found_links = cache.RedisExpiringSet('recent_found_links', expire=86400, local_size=10000,
+                                            max_size=1000000)
 group_last_changed = cache.RedisExpiringSet('group_last_changed', expire=3600)
 async def find_link_to_join(engine: aiomysql.sa.Engine, msg: str):
     public_links = set(PUBLIC_REGEX.findall(msg)).union(PUBLIC_AT_REGEX.findall(msg))
@@ -52,10 +53,9 @@ async def find_link_to_join(engine: aiomysql.sa.Engine, msg: str):
     for link in public_links:
         if link in config.GROUP_BLACKLIST:  # false detection of private link
             continue
-        if await recent_found_links.contains(link):
+        if await recent_found_links.touch(link):
             logger.warning(f'Group @{link} is in recent found links, skip')
             continue
-        await recent_found_links.add(link)
 
         await report_statistics(measurement='bot',
                                 tags={'type': 'discover',
@@ -67,9 +67,8 @@ async def find_link_to_join(engine: aiomysql.sa.Engine, msg: str):
 
     for link in private_links:
         invite_hash = link[-22:]
-        if await recent_found_links.contains(invite_hash):
+        if await recent_found_links.touch(invite_hash):
             continue
-        await recent_found_links.add(invite_hash)
 
         await report_statistics(measurement='bot',
                                 tags={'type': 'discover',
@@ -78,7 +77,7 @@ async def find_link_to_join(engine: aiomysql.sa.Engine, msg: str):
         await test_and_join_private_channel(engine, invite_hash, False)
 
 
-bot_info = cache.RedisDict('bot_info')
+bot_info = cache.RedisDict('bot_info', local_ttl=10)
 async def get_available_bot() -> Bot:
     all_bot = config.BOT_TOKENS
     blacklist = set()
@@ -187,13 +186,13 @@ async def test_and_join_public_channel(engine: aiomysql.sa.Engine, link: str, jo
        (info.title and is_chinese_message(info.title)) or \
        (info.description and is_chinese_message(info.description)) or \
        await is_chinese_group(group, info):
-        await workers.JoinGroupWorker.queue.put(to_json(dict(
+        await workers.JoinGroupWorker.queue.put(dict(
             link_type='public',
             link=link,
             group_type=info.type,
             title=info.title,
             count=count
-        )))
+        ))
         joined = True
 
     async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
@@ -240,13 +239,13 @@ async def test_and_join_private_channel(engine, invite_hash, join_now):
             return gid, False
 
     if join_now:
-        await workers.JoinGroupWorker.queue.put(to_json(dict(
+        await workers.JoinGroupWorker.queue.put(dict(
             link_type='private',
             link=invite_hash,
             group_type='channel' if group.broadcast else 'group',
             title=group.title,
             count=group.participants_count
-        )))
+        ))
         return gid, True
 
     if isinstance(group, ChatInvite) and group.participants_count > config.GROUP_MEMBER_JOIN_LIMIT:
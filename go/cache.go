@@ -1,8 +1,11 @@
 package main
 
 import (
+	"bytes"
+	"encoding/json"
 	"github.com/getsentry/raven-go"
 	"github.com/go-redis/redis"
+	"github.com/vmihailenco/msgpack"
 	"time"
 )
 
@@ -10,6 +13,26 @@ var client = redis.NewClient(RedisOptions)
 
 const QueuePrefix = "_queue"
 
+// EnvelopeVersion is the first byte of msgpack encoded queue items, other items are plain json
+const EnvelopeVersion = 1
+
+// UnmarshalItem decodes a queue item written either as json or as a versioned msgpack envelope.
+// Envelopes are converted via json, so the json tags and null types of models apply to both.
+func UnmarshalItem(b []byte, v interface{}) error {
+	if len(b) == 0 || b[0] != EnvelopeVersion {
+		return json.Unmarshal(b, v)
+	}
+	var item interface{}
+	if err := msgpack.NewDecoder(bytes.NewReader(b[1:])).Decode(&item); err != nil {
+		return err
+	}
+	j, err := json.Marshal(item)
+	if err != nil {
+		return err
+	}
+	return json.Unmarshal(j, v)
+}
+
 type RedisQueue struct {
 	Name string
 }
@@ -30,8 +53,16 @@ func (q RedisQueue) GetBytes() []byte {
 
 func (q RedisQueue) BulkGetBytes(count int) [][]byte {
 	var result [][]byte
+	pipe := client.Pipeline()
+	cmds := make([]*redis.StringCmd, count)
 	for i := 0; i < count; i++ {
-		if b := q.GetBytes(); b != nil {
+		cmds[i] = pipe.LPop(q.Name + QueuePrefix)
+	}
+	if _, err := pipe.Exec(); err != nil && err != redis.Nil {
+		raven.CaptureErrorAndWait(err, map[string]string{"module": "cache", "func": "bulk_get_bytes"})
+	}
+	for _, cmd := range cmds {
+		if b, err := cmd.Bytes(); err == nil {
 			result = append(result, b)
 		}
 	}
@@ -84,3 +115,20 @@ func (s RedisExpiringSet) Discard(item string) {
 func (s RedisExpiringSet) Clear() {
 	client.Del(s.Name)
 }
+
+// RedisPendingFlags holds flags of items not existing yet, see cache.RedisPendingFlags
+type RedisPendingFlags struct {
+	Name string
+}
+
+// Pop returns and removes the pending flags of key, 0 if none
+func (p RedisPendingFlags) Pop(key string) int16 {
+	pipe := client.TxPipeline()
+	get := pipe.Get(p.Name + ":" + key)
+	pipe.Del(p.Name + ":" + key)
+	if _, err := pipe.Exec(); err != nil && err != redis.Nil {
+		raven.CaptureErrorAndWait(err, map[string]string{"module": "cache", "func": "pending_pop"})
+	}
+	flag, _ := get.Int64()
+	return int16(flag)
+}
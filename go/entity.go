@@ -3,7 +3,6 @@ package main
 import (
 	_ "github.com/jinzhu/gorm/dialects/mysql"
 	"github.com/jinzhu/gorm"
-	"encoding/json"
 	"time"
 	"log"
 	"os"
@@ -178,7 +177,7 @@ func entityMain() {
 		}
 
 		var entity EntityItem
-		json.Unmarshal(msg, &entity)
+		UnmarshalItem(msg, &entity)
 
 		if entity.EntityType == "user" {
 			updateUser(db, &entity.User)
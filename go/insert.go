@@ -7,6 +7,7 @@ import (
 	_ "github.com/jinzhu/gorm/dialects/mysql"
 	"log"
 	"os"
+	"sort"
 	"strconv"
 	"strings"
 	"time"
@@ -21,6 +22,42 @@ func MessageUniqueKey(chat ChatNew) string {
 	return strconv.FormatInt(chat.ChatId, 10) + "-" + strconv.Itoa(chat.MessageId)
 }
 
+// updateSyncRanges widens message id ranges in group_sync to cover chats, see models.update_sync_ranges
+func updateSyncRanges(tx *gorm.DB, chats []ChatNew) error {
+	ranges := make(map[int64][2]int)
+	for _, chat := range chats {
+		r, ok := ranges[chat.ChatId]
+		if !ok {
+			r = [2]int{chat.MessageId, chat.MessageId}
+		}
+		if chat.MessageId < r[0] {
+			r[0] = chat.MessageId
+		}
+		if chat.MessageId > r[1] {
+			r[1] = chat.MessageId
+		}
+		ranges[chat.ChatId] = r
+	}
+	// same lock order as other inserters, avoids deadlocks
+	gids := make([]int64, 0, len(ranges))
+	for gid := range ranges {
+		gids = append(gids, gid)
+	}
+	sort.Slice(gids, func(i, j int) bool { return gids[i] < gids[j] })
+	for _, gid := range gids {
+		r := ranges[gid]
+		err := tx.Exec("INSERT INTO group_sync (gid, min_message_id, max_message_id, complete) VALUES (?, ?, ?, 0) "+
+			"ON DUPLICATE KEY UPDATE "+
+			"min_message_id = LEAST(COALESCE(min_message_id, VALUES(min_message_id)), VALUES(min_message_id)), "+
+			"max_message_id = GREATEST(COALESCE(max_message_id, VALUES(max_message_id)), VALUES(max_message_id))",
+			gid, r[0], r[1]).Error
+		if err != nil {
+			return err
+		}
+	}
+	return nil
+}
+
 func insertMain() {
 	logger := log.New(os.Stderr, "[INSERT] ", log.Ltime|log.Lshortfile)
 	db, err := gorm.Open("mysql", MysqlUrl)
@@ -29,6 +66,7 @@ func insertMain() {
 	insertQueue := RedisQueue{"insert"}
 	ocrQueue := RedisQueue{"ocr"}
 	insertSet := RedisExpiringSet{"insert_set", 10}
+	pendingFlags := RedisPendingFlags{"pending_flags"}
 
 	if err != nil {
 		raven.CaptureErrorAndWait(err, map[string]string{"module": "insert", "func": "start"})
@@ -46,16 +84,19 @@ func insertMain() {
 		}
 
 		tx := db.Begin()
+		var inserted []ChatNew
 
 		for _, msg := range messages {
 			var chat ChatNew
-			json.Unmarshal(msg, &chat)
+			UnmarshalItem(msg, &chat)
 
 			if chat.Flag == int16(ChatFlagNew) && insertSet.Contains(MessageUniqueKey(chat)) {
 				// ignore if inserted
 				continue
 			}
 
+			chat.Flag |= pendingFlags.Pop(MessageUniqueKey(chat))
+
 			for {
 				if err := tx.Create(&chat).Error; err != nil {
 					logger.Printf("insert message error: %v", err)
@@ -67,12 +108,12 @@ func insertMain() {
 			insertSet.Add(MessageUniqueKey(chat))
 			client.HSet("insert_worker_status", "last", time.Now().Unix())
 			client.HSet("insert_worker_status", "size", insertQueue.Size())
+			inserted = append(inserted, chat)
+		}
 
-			if strings.HasPrefix(chat.Text, OcrHint) {
-				item := OcrItem{Id: chat.ID, Tries: 0}
-				b, _ := json.Marshal(&item)
-				ocrQueue.PutBytes(b)
-			}
+		if err := updateSyncRanges(tx, inserted); err != nil {
+			logger.Printf("update group sync error: %v", err)
+			raven.CaptureErrorAndWait(err, map[string]string{"module": "insert", "func": "sync"})
 		}
 
 		if err := tx.Commit().Error; err != nil {
@@ -83,6 +124,22 @@ func insertMain() {
 
 			logger.Printf("insert commit error: %v", err)
 			raven.CaptureErrorAndWait(err, map[string]string{"module": "insert", "func": "commit"})
+			continue
+		}
+
+		for _, chat := range inserted {
+			// flags added while inserting
+			if flag := pendingFlags.Pop(MessageUniqueKey(chat)); flag != 0 {
+				db.Model(&ChatNew{}).Where("chatid = ? AND messageid = ?", chat.ChatId, chat.MessageId).
+					Update("flag", gorm.Expr("flag | ?", flag))
+			}
+
+			// queued after committed, so ocr worker finds the row
+			if strings.HasPrefix(chat.Text, OcrHint) {
+				item := OcrItem{Id: chat.ID, Tries: 0}
+				b, _ := json.Marshal(&item)
+				ocrQueue.PutBytes(b)
+			}
 		}
 	}
 }
@@ -3,7 +3,6 @@ package main
 import (
 	"github.com/jinzhu/gorm"
 	_ "github.com/jinzhu/gorm/dialects/mysql"
-	"encoding/json"
 	"log"
 	"os"
 	"time"
@@ -37,7 +36,7 @@ func inviteMain() {
 
 		for _, msg := range messages {
 			var item GroupInvite
-			json.Unmarshal(msg, &item)
+			UnmarshalItem(msg, &item)
 
 			for {
 				if err := tx.Create(&item).Error; err != nil {
@@ -54,9 +53,7 @@ func inviteMain() {
 		if err := tx.Commit().Error; err != nil {
 			tx.Rollback()
 			for _, msg := range messages {
-				var result []byte
-				result, err = json.Marshal(msg)
-				inviteQueue.PutBytes(result)
+				inviteQueue.PutBytes(msg)
 			}
 
 			logger.Printf("invite commit error: %v", err)
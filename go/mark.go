@@ -13,7 +13,8 @@ import (
 
 type MarkItem struct {
 	ChatId     int64  `json:"chat_id"`
-	MessageId  int    `json:"message_id"`
+	MessageId  int    `json:"message_id,omitempty"`
+	MessageIds []int  `json:"message_ids,omitempty"`
 	Tries      int    `json:"tries,omitempty"`
 }
 
@@ -44,11 +45,15 @@ func markMain() {
 
 		for _, msg := range messages {
 			var item MarkItem
-			json.Unmarshal(msg, &item)
+			UnmarshalItem(msg, &item)
+			ids := item.MessageIds
+			if len(ids) == 0 {
+				ids = []int{item.MessageId}
+			}
 
 			for {
 				var count int
-				db.Model(&ChatNew{}).Where(&ChatNew{ChatId: item.ChatId, MessageId: item.MessageId}).Count(&count)
+				db.Model(&ChatNew{}).Where("chatid = ? AND messageid IN (?)", item.ChatId, ids).Count(&count)
 
 				if count <= 0 {
 					item.Tries += 1
@@ -64,7 +69,7 @@ func markMain() {
 					}
 				}
 
-				err := db.Model(&ChatNew{}).Where(&ChatNew{ChatId: item.ChatId, MessageId: item.MessageId}).
+				err := db.Model(&ChatNew{}).Where("chatid = ? AND messageid IN (?)", item.ChatId, ids).
 					UpdateColumn("flag", gorm.Expr("flag | ?", ChatFlagDeleted)).Error
 
 				if err != nil {
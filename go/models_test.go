@@ -6,6 +6,7 @@ import (
 	"gopkg.in/guregu/null.v3"
 	"reflect"
 	"fmt"
+	"github.com/vmihailenco/msgpack"
 )
 
 func TestNormalChatUnmarshal(t *testing.T) {
@@ -50,3 +51,36 @@ func TestNullChatUnmarshal(t *testing.T) {
 		fmt.Printf("sample: %+v\n", sampleChat)
 	}
 }
+
+
+func TestEnvelopeChatUnmarshal(t *testing.T) {
+	packed, err := msgpack.Marshal(map[string]interface{}{
+		"chat_id":    -1001246822000,
+		"message_id": 128760,
+		"user_id":    nil,
+		"text":       "别人恐惧",
+		"date":       1525185960,
+		"flag":       0,
+	})
+	if err != nil {
+		t.Fatal(err)
+	}
+	sample := append([]byte{EnvelopeVersion}, packed...)
+	sampleChat := ChatNew{
+		ChatId:    -1001246822000,
+		MessageId: 128760,
+		UserId:    null.IntFromPtr(nil),
+		Text:      "别人恐惧",
+		Date:      1525185960,
+		Flag:      0,
+	}
+	var chat ChatNew
+	UnmarshalItem(sample, &chat)
+	if reflect.DeepEqual(chat, sampleChat) {
+		t.Log("same")
+	} else {
+		t.Error("different")
+		fmt.Printf("chat: %+v\n", chat)
+		fmt.Printf("sample: %+v\n", sampleChat)
+	}
+}
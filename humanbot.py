@@ -18,7 +18,8 @@ import cache
 import config
 from models import update_user_real, update_group_real, insert_message_local_timezone, ChatFlag
 from utils import get_now_timestamp, send_to_admin_channel, report_exception, \
-    peer_to_internal_id, need_to_be_online, get_photo_address, to_json, block, noblock, aiohttp_init, report_statistics
+    peer_to_internal_id, need_to_be_online, get_photo_address, to_json, block, noblock, aiohttp_init, \
+    report_statistics, statistics, global_count
 import session
 import senders
 import httpd
@@ -44,23 +45,24 @@ async def statistics_handler(bot, update, text):
             )
 
 
-user_last_changed = cache.RedisExpiringSet('user_last_changed', expire=3600)
+user_last_changed = cache.RedisExpiringSet('user_last_changed', expire=3600, local_size=10000, max_size=1000000)
 async def update_user(client, user_id):
-    if user_id is None or await user_last_changed.contains(user_id):  # user should be updated at a minute basis
+    if user_id is None or await user_last_changed.touch(user_id):  # user should be updated at a minute basis
         return
     try:
         user = await client.get_entity(PeerUser(user_id))  # type: User
         if isinstance(user, Channel):  # not a user
+            await user_last_changed.discard(user_id)
             return
     except (KeyError, TypeError) as e:
         logger.warning('Get user info failed: %s', user_id)
         report_exception()
+        await user_last_changed.discard(user_id)
         return
-    await user_last_changed.add(user_id)
     await update_user_real(user_id, user.first_name, user.last_name, user.username, user.lang_code)
 
 
-group_last_changed = cache.RedisExpiringSet('group_last_changed', expire=3600)
+group_last_changed = cache.RedisExpiringSet('group_last_changed', expire=3600, local_size=10000)
 async def update_group(client, chat_id: int, title: str = None):
     """
     Try to update group information
@@ -69,21 +71,22 @@ async def update_group(client, chat_id: int, title: str = None):
     :param title: New group title (optional)
     :return: None
     """
-    if await group_last_changed.contains(str(chat_id)):  # user should be updated at a minute basis
+    if await group_last_changed.touch(str(chat_id)):  # user should be updated at a minute basis
         return
     try:
         group = await client.get_entity(chat_id)
     except ValueError:
         uid = (await client.get_me(input_peer=True)).user_id
         report_exception()
+        await group_last_changed.discard(str(chat_id))
         # await send_to_admin_channel(f'client {uid} input entity failed for gid {chat_id}')
         return
     except ChannelPrivateError:
         uid = (await client.get_me(input_peer=True)).user_id
         report_exception()
+        await group_last_changed.discard(str(chat_id))
         await send_to_admin_channel(f'client {uid} input entity failed for gid {chat_id}: channel private error')
         return
-    await group_last_changed.add(str(chat_id))
     if isinstance(group, (Chat, ChatFull)):
         await update_group_real(client.conf['uid'], peer_to_internal_id(chat_id), title or group.title, None)
     elif isinstance(group, (Channel, ChannelFull)):
@@ -91,7 +94,6 @@ async def update_group(client, chat_id: int, title: str = None):
 
 
 thread_called_count = cache.RedisDict('thread_called_count')
-global_count = cache.RedisDict('global_count')
 def update_handler_wrapper(func):
     @wraps(func)
     async def wrapped(event: events.NewMessage):
@@ -124,8 +126,8 @@ def update_handler_wrapper(func):
 
         process_end_time = datetime.now()
         process_time = process_end_time - process_start_time
-        await global_count.incrby('received_message', 1)
-        await global_count.incrby('total_used_time', int(process_time.total_seconds()))
+        await global_count.incrby_many({'received_message': 1,
+                                        'total_used_time': int(process_time.total_seconds())})
 
     return wrapped
 
@@ -197,8 +199,7 @@ async def update_deleted_message_handler(event: events.MessageDeleted.Event):
     if not event.chat_id:
         logger.error('got a deleted event with chat_id None and message_id %r', event.deleted_ids)
         return
-    for message_id in event.deleted_ids:
-        await workers.MessageMarkWorker.queue.put(to_json(dict(chat_id=event.chat_id, message_id=message_id)))
+    await workers.MessageMarkWorker.queue.put(dict(chat_id=event.chat_id, message_ids=list(event.deleted_ids)))
     await update_group(event.client, event.chat_id)
 
 
@@ -267,10 +268,13 @@ async def main():
     senders.create_clients()
 
     await cache.RedisObject.init()
-    await global_count.set('received_message', 0)
-    await global_count.set('total_used_time', 0)
-    await global_count.set('start_time', get_now_timestamp())
+    noblock(cache.RedisDict.listen())
+    noblock(cache.RedisSingleFlight.listen())
+    await global_count.update({'received_message': 0, 'total_used_time': 0, 'start_time': get_now_timestamp()})
     await aiohttp_init()
+    noblock(statistics.run())
+    noblock(cache.RedisExpiringSet.sweeper(config.EXPIRING_SET_SWEEP_INTERVAL))
+    noblock(cache.RedisQueue.keeper(config.QUEUE_HEARTBEAT_INTERVAL))
 
     # launch clients
     for conf in config.CLIENTS:
@@ -282,14 +286,16 @@ async def main():
     # launching bot and workers
     await realbot.main()
     workers.FindLinkWorker().start()
-    # workers.MessageInsertWorker().start(4)
-    # workers.EntityUpdateWorker().start()
-    # workers.MessageMarkWorker().start()
-    workers.FetchHistoryWorker().start()
-    workers.OcrWorker().start(8)
+    workers.MessageInsertWorker().start(2)
+    workers.EntityUpdateWorker().start()
+    workers.MessageMarkWorker().start()
+    workers.FetchHistoryWorker().start(config.HISTORY_CONCURRENCY)
+    workers.OcrWorker().start(config.OCR_IN_FLIGHT)
     workers.InviteWorker().start()
     workers.JoinGroupWorker().start()
     workers.ReportStatisticsWorker().start()
+    noblock(workers.supervisor.run())
+    noblock(workers.delayed.mover(config.DELAYED_MOVE_INTERVAL))
     noblock(httpd.main())
 
     # for debugging
@@ -303,6 +309,7 @@ async def main():
             break
 
     # cleanup
+    await statistics.flush()
     for conf in config.CLIENTS + config.NEW_BOTS:
         conf['client'].disconnect()
 
@@ -1,7 +1,12 @@
+import asyncio
 from datetime import datetime, timezone
 from logging import getLogger
+from time import monotonic
+from typing import List, Dict, Set
 
+import sqlalchemy
 from sqlalchemy import engine_from_config, func
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Table, Column, Index, \
     Integer, BigInteger, SmallInteger, String, Text
@@ -94,6 +99,15 @@ class GroupInvite(Base):
     date = Column('date', Integer, index=True)
 
 
+class GroupSync(Base):
+    __tablename__ = 'group_sync'
+    gid = Column('gid', BigInteger(), primary_key=True)
+    min_message_id = Column('min_message_id', Integer())  # lowest message id stored, by live or history
+    max_message_id = Column('max_message_id', Integer())  # highest message id stored
+    backfill_time = Column('backfill_time', Integer())  # last history page stored
+    complete = Column('complete', SmallInteger(), nullable=False, default=0, index=True)  # history all fetched
+
+
 engine = engine_from_config(config.DB_CONFIG, echo=not config.PRODUCTION)
 
 session_factory = sessionmaker(bind=engine)
@@ -101,12 +115,128 @@ session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
 
 
-async def get_aio_engine():
+class PoolMeter:
+    """
+    Usage of connections acquired through `LimitedEngine`s
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.total_wait = 0.0  # seconds
+        self.max_wait = 0.0
+
+    def stat(self) -> str:
+        return '{}: {} in use, {} waiting, {} acquired, {:.3f}s wait on average, {:.3f}s max\n'.format(
+            self.name, self.in_use, self.waiting, self.acquired,
+            self.total_wait / (self.acquired or 1), self.max_wait)
+
+
+class AcquireContext:
+    def __init__(self, engine: 'LimitedEngine'):
+        self.engine = engine
+        self.conn = None
+
+    async def __aenter__(self):
+        engine = self.engine
+        meters = (engine.meter, engine.pool_meter)
+        started = monotonic()
+        for meter in meters:
+            meter.waiting += 1
+        try:
+            if engine.semaphore is not None:
+                await engine.semaphore.acquire()
+            try:
+                self.conn = await engine.engine.acquire()
+            except:
+                if engine.semaphore is not None:
+                    engine.semaphore.release()
+                raise
+        finally:
+            for meter in meters:
+                meter.waiting -= 1
+
+        waited = monotonic() - started
+        for meter in meters:
+            meter.in_use += 1
+            meter.acquired += 1
+            meter.total_wait += waited
+            meter.max_wait = max(meter.max_wait, waited)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        engine = self.engine
+        try:
+            await self.conn.close()  # back to pool
+        finally:
+            for meter in (engine.meter, engine.pool_meter):
+                meter.in_use -= 1
+            if engine.semaphore is not None:
+                engine.semaphore.release()
+
+
+class LimitedEngine:
+    """
+    Shared aiomysql.sa engine, with at most `quota` connections acquired through it at once if set
+    """
+    pool_meter = PoolMeter('mysql pool')
+
+    def __init__(self, engine, name: str, quota: int = 0):
+        self.engine = engine
+        self.meter = PoolMeter(name)
+        self.semaphore = asyncio.Semaphore(quota) if quota else None
+
+    def acquire(self) -> AcquireContext:
+        return AcquireContext(self)
+
+
+aio_engine = None  # shared in process
+aio_engine_lock = asyncio.Lock()
+limited_engines = {}  # name -> LimitedEngine
+
+
+async def check_autoinc(engine):
+    """
+    Fail unless ids of a multi-row insert are consecutive, as insert_messages assumes
+    """
+    async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+        result = await conn.execute('SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment')
+        lock_mode, increment = await result.fetchone()
+    if lock_mode > 1 or increment != 1:
+        engine.close()
+        await engine.wait_closed()
+        raise RuntimeError('innodb_autoinc_lock_mode <= 1 and auto_increment_increment = 1 required, '
+                           'got {} and {}'.format(lock_mode, increment))
+
+
+async def get_aio_engine(name: str = '') -> LimitedEngine:
+    """
+    Engine sharing the pool of process, sized `MYSQL_POOL_SIZE`
+
+    :param name: user of connections, usually a worker name, limited by `MYSQL_QUOTAS` if found
+    """
+    global aio_engine
     import aiomysql.sa
-    return await aiomysql.sa.create_engine(**config.MYSQL_CONFIG,
-                                           db=config.MYSQL_DATABASE,
-                                           charset='utf8mb4',
-                                           autocommit=True)
+    async with aio_engine_lock:
+        if aio_engine is None:
+            engine = await aiomysql.sa.create_engine(**config.MYSQL_CONFIG,
+                                                     db=config.MYSQL_DATABASE,
+                                                     charset='utf8mb4',
+                                                     autocommit=True,
+                                                     maxsize=config.MYSQL_POOL_SIZE)
+            await check_autoinc(engine)
+            aio_engine = engine
+    if name not in limited_engines:
+        limited_engines[name] = LimitedEngine(aio_engine, name or 'other', config.MYSQL_QUOTAS.get(name, 0))
+    return limited_engines[name]
+
+
+def pool_stat() -> str:
+    result = LimitedEngine.pool_meter.stat()
+    if aio_engine is not None:
+        result = '{} connections, {} free, '.format(aio_engine.size, aio_engine.freesize) + result
+    return result + ''.join('  ' + engine.meter.stat() for engine in limited_engines.values())
 
 
 async def update_user_real(user_id, first_name, last_name, username, lang_code):
@@ -121,7 +251,7 @@ async def update_user_real(user_id, first_name, last_name, username, lang_code):
     :return:
     """
     from workers import EntityUpdateWorker
-    await EntityUpdateWorker.queue.put(utils.to_json(dict(
+    await EntityUpdateWorker.queue.put(dict(
         type='user',
         user=dict(
             user_id=user_id,
@@ -130,45 +260,7 @@ async def update_user_real(user_id, first_name, last_name, username, lang_code):
             username=username,
             lang_code=lang_code
         )
-    )))
-
-
-def update_user(session, user_id, first_name, last_name, username, lang_code):
-    logger.debug('User %s %s %s %s %s', user_id, first_name, last_name, username, lang_code)
-
-    user = session.query(User).filter(User.uid == user_id).one_or_none()
-    if not user:  # new user
-        user = User(uid=user_id,
-                    first_name=first_name,
-                    last_name=last_name,
-                    username=username,
-                    lang_code=lang_code)
-
-        session.add(user)
-    else:  # existing user
-        same = user.first_name == first_name and user.last_name == last_name and user.username == username
-        if not same:  # information changed
-            changed_before = session.query(UsernameHistory).filter(UsernameHistory.uid == user_id).count()
-            if not changed_before:
-                original = UsernameHistory(uid=user_id,
-                                           username=user.username,
-                                           first_name=user.first_name,
-                                           last_name=user.last_name,
-                                           lang_code=user.lang_code,
-                                           date=0)
-                session.add(original)
-            user.first_name = first_name
-            user.last_name = last_name
-            user.username = username
-            user.lang_code = lang_code
-            change = UsernameHistory(uid=user_id,
-                                     username=username,
-                                     first_name=first_name,
-                                     last_name=last_name,
-                                     lang_code=lang_code,
-                                     date=utils.get_now_timestamp()
-                                     )
-            session.add(change)
+    ))
 
 
 async def update_group_real(master_uid, chat_id, name, link):
@@ -182,7 +274,7 @@ async def update_group_real(master_uid, chat_id, name, link):
     :return:
     """
     from workers import EntityUpdateWorker
-    await EntityUpdateWorker.queue.put(utils.to_json(dict(
+    await EntityUpdateWorker.queue.put(dict(
         type='group',
         group=dict(
             master_uid=master_uid,
@@ -190,48 +282,19 @@ async def update_group_real(master_uid, chat_id, name, link):
             name=name,
             link=link
         )
-    )))
+    ))
 
 
 async def update_group_invite(gid, creator, secret, invite, name):
     from workers import InviteWorker
-    await InviteWorker.queue.put(utils.to_json(dict(
+    await InviteWorker.queue.put(dict(
         gid=gid,
         creator=creator,
         secret=secret,
         invite=invite,
         name=name,
         date=utils.get_now_timestamp()
-    )))
-
-
-def update_group(session, master_uid, chat_id, name, link):
-    logger.debug('group %s %s %s', chat_id, name, link)
-
-    group = session.query(Group).filter(Group.gid == chat_id).one_or_none()
-    if not group:  # new group
-        group = Group(gid=chat_id, name=name, link=link, master=master_uid)
-        session.add(group)
-    else:  # existing group
-        same = group.name == name and group.link == link
-        if group.master is None:
-            group.master = master_uid
-        if not same:  # information changed
-            changed_before = session.query(GroupHistory).filter(GroupHistory.gid == chat_id).count()
-            if not changed_before:
-                original = GroupHistory(gid=chat_id,
-                                        name=group.name,
-                                        link=group.link,
-                                        date=0)
-                session.add(original)
-            group.name = name
-            group.link = link
-            change = GroupHistory(gid=chat_id,
-                                  name=name,
-                                  link=link,
-                                  date=utils.get_now_timestamp()
-                                  )
-            session.add(change)
+    ))
 
 
 async def insert_message(chat_id: int, message_id, user_id: int, msg: str, date: datetime, flag=ChatFlag.new, find_link=True):
@@ -251,13 +314,264 @@ async def insert_message(chat_id: int, message_id, user_id: int, msg: str, date:
                 date=utc_timestamp,
                 flag=flag)
 
-    await MessageInsertWorker.queue.put(utils.to_json(chat))
+    await MessageInsertWorker.queue.put(chat)
 
     if not find_link:
         return
     await find_link_enqueue(msg)
 
 
+def message_key(chat_id: int, message_id: int) -> str:
+    return '{}-{}'.format(chat_id, message_id)
+
+
+def chat_row(chat: dict) -> dict:
+    return {
+        'chatid': chat['chat_id'],
+        'messageid': chat['message_id'],
+        'userid': chat['user_id'],
+        'text': chat['text'],
+        'time': chat['date'],
+        'flag': chat['flag'],
+    }
+
+
+async def insert_messages(conn, chats: List[dict]) -> List[int]:
+    """
+    Insert messages (in queue format) with one multi-row INSERT
+
+    :param conn: aiomysql.sa.SAConnection
+    :param chats: messages
+    :return: ids of inserted rows, consecutive since the first one, see check_autoinc
+    """
+    if not chats:
+        return []
+    result = await conn.execute(Core.ChatNew.insert().values([chat_row(chat) for chat in chats]))
+    await update_sync_ranges(conn, chats)
+    await conn.execute('COMMIT')
+    first_id = result.lastrowid
+    return list(range(first_id, first_id + len(chats)))
+
+
+async def update_sync_ranges(conn, chats: List[dict]):
+    """
+    Widen message id ranges in group_sync to cover messages, with one statement.
+    Rows are written in gid order so concurrent inserters lock them in the same order.
+    """
+    ranges = {}  # chat id -> [min, max]
+    for chat in chats:
+        r = ranges.setdefault(chat['chat_id'], [chat['message_id'], chat['message_id']])
+        r[0] = min(r[0], chat['message_id'])
+        r[1] = max(r[1], chat['message_id'])
+    stmt = mysql.insert(Core.GroupSync).values([dict(gid=gid, min_message_id=low, max_message_id=high)
+                                                for gid, (low, high) in sorted(ranges.items())])
+    table = Core.GroupSync.c
+    await conn.execute(stmt.on_duplicate_key_update(
+        min_message_id=func.least(func.coalesce(table.min_message_id, stmt.inserted.min_message_id),
+                                  stmt.inserted.min_message_id),
+        max_message_id=func.greatest(func.coalesce(table.max_message_id, stmt.inserted.max_message_id),
+                                     stmt.inserted.max_message_id),
+    ))
+
+
+SEED_GROUP_SYNC_SQL = '''
+INSERT INTO group_sync (gid, min_message_id, max_message_id, complete)
+SELECT chatid, MIN(messageid), MAX(messageid), 0 FROM chat_new GROUP BY chatid
+ON DUPLICATE KEY UPDATE
+min_message_id = LEAST(COALESCE(min_message_id, VALUES(min_message_id)), VALUES(min_message_id)),
+max_message_id = GREATEST(COALESCE(max_message_id, VALUES(max_message_id)), VALUES(max_message_id))
+'''
+
+
+def seed_group_sync(connection):
+    """
+    Widen group_sync ranges to cover messages stored before it, once after it is created.
+    Rows created by live inserts meanwhile are widened as well, so running it again is harmless.
+    """
+    if connection.dialect.name != 'mysql':
+        logger.warning('group_sync is seeded on mysql only')
+        return
+    connection.execute(sqlalchemy.text(SEED_GROUP_SYNC_SQL))
+
+
+async def get_sync_state(conn, gid: int):
+    """
+    Sync state of a group, created from messages stored if missing
+
+    :param conn: aiomysql.sa.SAConnection
+    :return: group_sync row, None if no message stored
+    """
+    result = await conn.execute(Core.GroupSync.select().where(GroupSync.gid == gid))
+    row = await result.fetchone()
+    if row is not None:
+        return row
+
+    # groups stored before group_sync if not seeded, scanned once
+    stmt = sqlalchemy.select([func.min(ChatNew.message_id), func.max(ChatNew.message_id)]).\
+        where(ChatNew.chat_id == gid)
+    low, high = await (await conn.execute(stmt)).fetchone()
+    if low is None:
+        return None
+    await update_sync_ranges(conn, [dict(chat_id=gid, message_id=low), dict(chat_id=gid, message_id=high)])
+    await conn.execute('COMMIT')
+    result = await conn.execute(Core.GroupSync.select().where(GroupSync.gid == gid))
+    return await result.fetchone()
+
+
+async def set_backfill_state(conn, gid: int, complete: bool = False):
+    """
+    Record a history page stored, or history all fetched
+    """
+    await conn.execute(Core.GroupSync.update().where(GroupSync.gid == gid).
+                       values(backfill_time=utils.get_now_timestamp(), complete=int(complete)))
+    await conn.execute('COMMIT')
+
+
+async def incomplete_groups(conn, limit: int = 100) -> list:
+    """
+    :return: group_sync rows of groups with history not all fetched, by lowest message id stored descending
+    """
+    stmt = Core.GroupSync.select().where(GroupSync.complete == 0).\
+        order_by(GroupSync.min_message_id.desc()).limit(limit)
+    return await (await conn.execute(stmt)).fetchall()
+
+
+async def mark_messages(conn, groups: Dict[int, Set[int]], flag: int) -> Dict[int, Set[int]]:
+    """
+    Set flag of messages with one UPDATE per chat
+
+    :param conn: aiomysql.sa.SAConnection
+    :param groups: chat id -> message ids
+    :param flag: ChatFlag
+    :return: chat id -> message ids not found
+    """
+    missing = {}
+    async with conn.begin():
+        for chat_id, message_ids in groups.items():
+            where = sqlalchemy.and_(ChatNew.chat_id == chat_id, ChatNew.message_id.in_(message_ids))
+            result = await conn.execute(Core.ChatNew.update().where(where).values(flag=ChatNew.flag.op('|')(flag)))
+            if result.rowcount >= len(message_ids):
+                continue
+            # changed rows are counted, rows flagged before are found here
+            found = await conn.execute(sqlalchemy.select([ChatNew.message_id]).where(where))
+            not_found = set(message_ids) - {row[0] for row in await found.fetchall()}
+            if not_found:
+                missing[chat_id] = not_found
+    return missing
+
+
+async def update_texts(conn, texts: Dict[int, str]):
+    """
+    Set text of messages with one UPDATE
+
+    :param conn: aiomysql.sa.SAConnection
+    :param texts: message row id -> text
+    """
+    if not texts:
+        return
+    stmt = Core.ChatNew.update().\
+        where(ChatNew.id.in_(list(texts))).\
+        values(text=sqlalchemy.case(texts, value=ChatNew.id))
+    await conn.execute(stmt)
+    await conn.execute('COMMIT')
+
+
+def user_row(user: dict) -> dict:
+    return {
+        'uid': user['user_id'],
+        'name': user['username'],
+        'firstname': user['first_name'],
+        'lastname': user['last_name'],
+        'lang': user['lang_code'],
+    }
+
+
+def group_row(group: dict) -> dict:
+    return {
+        'id': group['chat_id'],
+        'name': group['name'],
+        'link': group['link'],
+        'master': group['master_uid'],
+    }
+
+
+async def upsert_entities(conn, table: Table, history: Table, history_key: str, rows: List[dict],
+                          fields: List[str], fill: List[str] = ()) -> int:
+    """
+    Insert or update entities with one statement, and record changes in history with another one
+
+    :param conn: aiomysql.sa.SAConnection
+    :param table: entity table, primary key is the first column
+    :param history: history table of `fields`, with `history_key` referring to the entity and `date`
+    :param rows: entity rows, the last one wins for the same entity
+    :param fields: columns recorded in history
+    :param fill: columns only set when null
+    :return: count of new or changed entities
+    """
+    key = table.primary_key.columns.values()[0].name
+    rows = list({row[key]: row for row in rows}.values())
+    if not rows:
+        return 0
+
+    async with conn.begin():
+        result = await conn.execute(table.select().where(table.c[key].in_([row[key] for row in rows])))
+        existing = {row[key]: row for row in await result.fetchall()}
+
+        changed = [row for row in rows
+                   if row[key] not in existing
+                   or any(existing[row[key]][field] != row[field] for field in fields)
+                   or any(existing[row[key]][field] is None and row[field] is not None for field in fill)]
+        if not changed:
+            return 0
+
+        history_ids = [row[key] for row in changed
+                       if row[key] in existing and any(existing[row[key]][field] != row[field] for field in fields)]
+        histories = []
+        if history_ids:
+            # original values are recorded (with date 0) on the first change only
+            result = await conn.execute(sqlalchemy.select([history.c[history_key]]).distinct()
+                                        .where(history.c[history_key].in_(history_ids)))
+            has_history = {row[0] for row in await result.fetchall()}
+            now = utils.get_now_timestamp()
+            for entity_id in history_ids:
+                if entity_id not in has_history:
+                    original = dict({field: existing[entity_id][field] for field in fields}, date=0)
+                    histories.append(dict(original, **{history_key: entity_id}))
+            history_ids = set(history_ids)
+            for row in changed:
+                if row[key] in history_ids:
+                    change = dict({field: row[field] for field in fields}, date=now)
+                    histories.append(dict(change, **{history_key: row[key]}))
+
+        stmt = mysql.insert(table).values(changed)
+        updates = {field: stmt.inserted[field] for field in fields}
+        updates.update({field: func.coalesce(table.c[field], stmt.inserted[field]) for field in fill})
+        await conn.execute(stmt.on_duplicate_key_update(**updates))
+        if histories:
+            await conn.execute(history.insert().values(histories))
+    return len(changed)
+
+
+async def upsert_users(conn, users: List[dict]) -> int:
+    """
+    :param conn: aiomysql.sa.SAConnection
+    :param users: users in queue format
+    :return: count of new or changed users
+    """
+    return await upsert_entities(conn, Core.User, Core.UsernameHistory, 'uid', [user_row(user) for user in users],
+                                 fields=['name', 'firstname', 'lastname'], fill=['lang'])  # as go entity worker
+
+
+async def upsert_groups(conn, groups: List[dict]) -> int:
+    """
+    :param conn: aiomysql.sa.SAConnection
+    :param groups: groups in queue format
+    :return: count of new or changed groups
+    """
+    return await upsert_entities(conn, Core.Group, Core.GroupHistory, 'gid', [group_row(group) for group in groups],
+                                 fields=['name', 'link'], fill=['master'])
+
+
 async def insert_message_local_timezone(chat_id, message_id, user_id, msg, date: datetime, flag=ChatFlag.new):
     try:
         utc_date = date.replace(tzinfo=timezone.utc)
@@ -269,8 +583,14 @@ async def insert_message_local_timezone(chat_id, message_id, user_id, msg, date:
 class Core:
     ChatNew = Base.metadata.tables['chat_new']  # type: Table
     Group = Base.metadata.tables['groups']  # type: Table
+    GroupHistory = Base.metadata.tables['group_history']  # type: Table
+    User = Base.metadata.tables['users']  # type: Table
+    UsernameHistory = Base.metadata.tables['user_history']  # type: Table
     GroupInvite = Base.metadata.tables['group_invites']  # type: Table
+    GroupSync = Base.metadata.tables['group_sync']  # type: Table
 
 
 if __name__ == '__main__':
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        seed_group_sync(connection)
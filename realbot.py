@@ -29,12 +29,15 @@ async def update_user(user: User):
     await update_user_real(user.id, user.first_name, user.last_name, user.username, user.language_code)
 
 
-bot_group_last_changed = cache.RedisExpiringSet('bot_group_last_changed', expire=300)
+bot_group_last_changed = cache.RedisExpiringSet('bot_group_last_changed', expire=300, local_size=1000)
 async def update_group(bot: Bot, chat_id: int):
-    if await bot_group_last_changed.contains(str(chat_id)):
+    if await bot_group_last_changed.touch(str(chat_id)):
         return
-    chat = await bot.get_chat(chat_id)
-    await bot_group_last_changed.add(str(chat_id))
+    try:
+        chat = await bot.get_chat(chat_id)
+    except:
+        await bot_group_last_changed.discard(str(chat_id))
+        raise
     if chat.type in [ChatType.GROUP, ChatType.SUPER_GROUP]:
         await update_group_real((await bot.me).id, chat.id, chat.title, chat.username)
 
@@ -162,6 +165,9 @@ async def main():
             dispatcher.register_command_handler('threads', humanbot.threads_handler)
             dispatcher.register_command_handler('workers', workers.workers_handler)
             dispatcher.register_command_handler('fetch', workers.history_add_handler)
+            dispatcher.register_command_handler('gaps', workers.history_gaps_handler)
+            dispatcher.register_command_handler('dead', workers.dead_letters_handler)
+            dispatcher.register_command_handler('replay', workers.replay_dead_letters_handler)
             dispatcher.register_command_handler('dialogs', admin.dialogs_handler)
             # dispatcher.register_command_handler('help', show_commands_handler)
 
@@ -1,5 +1,7 @@
 import asyncio
 import traceback
+from collections import defaultdict
+from concurrent.futures import CancelledError
 from datetime import datetime, timedelta
 from logging import getLogger
 from io import BytesIO
@@ -182,8 +184,8 @@ def get_random_time(hour):
     return int(time.timestamp())
 
 
+global_count = cache.RedisDict('global_count', local_ttl=60)
 async def need_to_be_online():
-    global_count = cache.RedisDict('global_count')
     today = datetime.now().strftime('%Y-%m-%d')
 
     if await global_count['today'] != today:
@@ -197,7 +199,7 @@ async def need_to_be_online():
     return False
 
 
-async def get_photo_address(client: TelegramClient, media: Photo):
+async def get_photo_address(client: TelegramClient, media: Photo, client_id: int = None):
     # get largest photo
     original = media.sizes[-1]
     location = original.location  # type: FileLocation
@@ -208,7 +210,7 @@ async def get_photo_address(client: TelegramClient, media: Photo):
     return to_json(dict(
         location=location.to_dict(),
         input_location=input_location_json,
-        client=(await client.get_me(input_peer=True)).user_id,
+        client=client_id or (await client.get_me(input_peer=True)).user_id,
         path='{}/{}'.format(now.year, now.month),
         filename='{}-{}_{}_{}.jpg'.format(get_now_timestamp(),
                                           dc_id,
@@ -217,13 +219,61 @@ async def get_photo_address(client: TelegramClient, media: Photo):
     ))
 
 
-async def report_statistics(measurement: str, tags: dict, fields: dict):
-    global_statistics = cache.RedisDict('global_statistics')
+class StatisticsAggregator:
+    """
+    Sum statistics up in process, and flush them into redis hash in one pipeline
+    every `interval` seconds or when `threshold` distinct counters are pending
+    """
+    def __init__(self, name: str, interval: int, threshold: int):
+        self.storage = cache.RedisDict(name)
+        self.interval = interval
+        self.threshold = threshold
+        self.counters = defaultdict(int)  # (measurement, tags, field) -> value
+
+    def add(self, measurement: str, tags: dict, fields: dict):
+        frozen_tags = tuple(tags.items())
+        for k, v in fields.items():
+            self.counters[(measurement, frozen_tags, k)] += v
+        if len(self.counters) >= self.threshold:
+            noblock(self.flush())
+
+    async def flush(self):
+        if not self.counters:
+            return
+        counters, self.counters = self.counters, defaultdict(int)
+
+        increments = {}
+        for (measurement, frozen_tags, k), v in counters.items():
+            new_tags = dict(frozen_tags)
+            new_tags['key'] = k
+            increments[measurement + '|' + to_json(new_tags)] = v
+        try:
+            await self.storage.incrby_many(increments)
+        except:
+            for key, v in counters.items():  # keep them for next flush
+                self.counters[key] += v
+            raise
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+            except CancelledError:
+                await self.flush()
+                break
+            except:
+                logger.exception('flush statistics failed')
+                report_exception()
+
+
+statistics = StatisticsAggregator('global_statistics',
+                                  interval=config.STATISTICS_FLUSH_INTERVAL,
+                                  threshold=config.STATISTICS_FLUSH_THRESHOLD)
 
-    for k, v in fields.items():
-        new_tags = tags.copy()
-        new_tags['key'] = k
-        await global_statistics.incrby(measurement + '|' + to_json(new_tags), v)
+
+async def report_statistics(measurement: str, tags: dict, fields: dict):
+    statistics.add(measurement, tags, fields)
 
 
 def block(c):
@@ -1,12 +1,17 @@
 import asyncio
+import math
+import random
 from io import BytesIO
 from threading import Thread
 import traceback
 from logging import getLogger, WARNING
 from cProfile import Profile
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from concurrent.futures import CancelledError
 from base64 import b64decode, b64encode
+from hashlib import sha1
+from collections import OrderedDict, deque, defaultdict
+from typing import List, Optional, Callable, Awaitable
 
 from aiogram.utils.exceptions import BadRequest
 from telethon import TelegramClient
@@ -15,11 +20,15 @@ from telethon.tl.functions.messages import ImportChatInviteRequest
 from telethon.tl.types import Message, MessageService, InputPhotoFileLocation, User, MessageMediaPhoto, ChatInvite
 from telethon.extensions import markdown
 from telethon.errors import AuthKeyUnregisteredError, FloodWaitError, ChannelPrivateError, \
-    RpcCallFailError, ChannelsTooMuchError, FileMigrateError, LocationInvalidError, FileIdInvalidError
+    RpcCallFailError, ChannelsTooMuchError, FileMigrateError, LocationInvalidError, FileIdInvalidError, \
+    FileReferenceExpiredError
 from aiogram import Bot
 
 import aiomysql.sa
+import aioredis
+import pymysql
 import sqlalchemy
+from sqlalchemy.dialects import mysql
 from aioinflux import InfluxDBClient
 
 import cache
@@ -27,18 +36,21 @@ import config
 import models
 import senders
 from utils import get_now_timestamp, report_exception, upload_pic, ocr, get_photo_address, from_json, to_json, \
-    send_to_admin_channel, noblock, block, OcrError, tg_html_entity, report_statistics
+    send_to_admin_channel, noblock, block, OcrError, tg_html_entity, report_statistics, global_count
 
 logger = getLogger(__name__)
 
 
 class WorkProperties(type):
     def __new__(mcs, class_name, class_bases, class_dict):
-        name = class_dict['name']
-        new_class_dict = class_dict.copy()
-        new_class_dict['status'] = cache.RedisDict(name + '_worker_status')
-        new_class_dict['queue'] = cache.RedisQueue(name + '_queue')
-        return type.__new__(mcs, class_name, class_bases, new_class_dict)
+        cls = type.__new__(mcs, class_name, class_bases, class_dict)
+        name = cls.name
+        codec = config.QUEUE_CODECS.get(name, cls.codec)
+        backend = config.QUEUE_BACKENDS.get(name, config.QUEUE_BACKEND_DEFAULT)
+        weights = config.QUEUE_LANE_WEIGHTS.get(name, cls.lane_weights)
+        cls.status = cache.make_dict(name + '_worker_status', backend)
+        cls.queue = cache.make_queue(name + '_queue', codec, backend, cls.lanes, weights)
+        return cls
 
 
 class Worker(Thread, metaclass=WorkProperties):
@@ -46,6 +58,9 @@ class Worker(Thread, metaclass=WorkProperties):
     Deprecated thread based worker, for reference only
     """
     name = ''
+    codec = 'json'
+    lanes = ()
+    lane_weights = None
     status = None  # type: cache.RedisDict
     queue = None  # type: cache.RedisQueue
 
@@ -96,61 +111,213 @@ class Worker(Thread, metaclass=WorkProperties):
 
 class CoroutineWorker(metaclass=WorkProperties):
     name = ''
+    codec = 'envelope'  # of queue items, handlers get decoded messages
+    lanes = ()  # names of queue lanes by priority, items are put into the first one by default
+    lane_weights = None  # lane name -> weight for weighted selection, strict priority if None
     status = None  # type: cache.RedisDict
     queue = None  # type: cache.RedisQueue
+    reliable = True  # blocking pop with acknowledgement, instead of polling
+    pop_timeout = 1
+    batch_size = 1  # max messages passed to handle_batch at once
+    batch_linger = 0  # max seconds waiting for a batch to fill up
+
+    item_latency = 0.0  # seconds handling a message, moving average of the class
+    max_attempts = 5  # failures of a message before it is dead
+    retry_delay = 1  # seconds before first retry, doubled for each following one
+    retry_max_delay = 600
 
     def __init__(self):
         self.logger = getLogger('worker-' + self.name)
         self.logger.setLevel(WARNING)
+        self.depth = 0  # queue size seen after last batch
+        self.stopping = False  # set by supervisor, the worker exits after current batch
+
+    @classmethod
+    def record_latency(cls, seconds: float, count: int):
+        latency = seconds / count
+        cls.item_latency = 0.8 * cls.item_latency + 0.2 * latency if cls.item_latency else latency
+
+    def batch_limit(self) -> int:
+        return self.batch_size
 
     async def __call__(self, *args, **kwargs):
         await self.run()
 
+    async def fetch_some(self, count: int, timeout: float) -> List[str]:
+        if self.reliable:
+            return await self.queue.pop_many(count, timeout)
+        messages = await self.queue.get_many(count)
+        if not messages:
+            self.logger.info('%s no message, sleep', self.name)
+            await asyncio.sleep(min(0.01, timeout))
+        return messages
+
+    async def fetch(self) -> List[str]:
+        limit = self.batch_limit()
+        messages = await self.fetch_some(limit, self.pop_timeout)
+        if not messages or not self.batch_linger:
+            return messages
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.batch_linger
+        while len(messages) < limit:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            messages += await self.fetch_some(limit - len(messages), remaining)
+        return messages
+
+    async def done(self, messages: List[str]):
+        if self.reliable:
+            await self.queue.ack_many(messages)
+        else:
+            await self.queue.task_done()
+        self.depth = await self.queue.qsize()
+        await self.status.update({'last': get_now_timestamp(), 'size': self.depth})
+
+    async def requeue(self, messages: List[str]):
+        await self.queue.requeue_many(messages)
+
+    def backoff(self, attempts: int) -> float:
+        """
+        :return: seconds before next retry, at random up to the exponential delay
+        """
+        return random.uniform(0, min(self.retry_delay * 2 ** (attempts - 1), self.retry_max_delay))
+
+    @staticmethod
+    def transient(error: Exception) -> bool:
+        """
+        :return: whether the error is of database or redis connections, likely failing every message alike
+        """
+        return isinstance(error, (ConnectionError, asyncio.TimeoutError, pymysql.err.OperationalError,
+                                  pymysql.err.InterfaceError, aioredis.ConnectionClosedError,
+                                  aioredis.PoolClosedError))
+
+    async def isolate(self, engine, messages: list) -> list:
+        """
+        Bisect a failed batch, so that only messages failing alone are charged an attempt.
+        Halves failing with transient errors are not split further.
+
+        :return: [(message, error)] of messages failed
+        """
+        failed = []
+        half = len(messages) // 2
+        for part in (messages[:half], messages[half:]):
+            try:
+                await self.handle_batch(engine, [self.queue.decode(message) for message in part])
+            except Exception as e:
+                if len(part) == 1 or self.transient(e):
+                    failed += [(message, e) for message in part]
+                else:
+                    failed += await self.isolate(engine, part)
+            else:
+                await self.done(part)
+        return failed
+
+    async def retry(self, messages: list, error: Exception):
+        """
+        Retry failed messages later, or leave them in dead letters after `max_attempts` failures
+        """
+        by_queue = defaultdict(list)  # queue name -> decoded messages, lanes are retried into themselves
+        for message in messages:
+            queue = message.lane if isinstance(message, cache.LaneItem) else self.queue
+            by_queue[queue.name].append(self.queue.decode(message))
+
+        dead_count = 0
+        for queue_name, values in by_queue.items():
+            attempts = await delayed.attempt(queue_name, values)
+            dead = [(value, n) for value, n in zip(values, attempts) if n >= self.max_attempts]
+            alive = [(value, n) for value, n in zip(values, attempts) if n < self.max_attempts]
+            await delayed.put_many(queue_name, [value for value, n in alive], [self.backoff(n) for value, n in alive])
+            if dead:
+                await cache.RedisDeadLetters(queue_name).push_many([value for value, n in dead], repr(error),
+                                                                   [n for value, n in dead])
+                await delayed.forget(queue_name, [value for value, n in dead])
+                dead_count += len(dead)
+
+        if self.reliable:
+            await self.queue.ack_many(messages)
+        return dead_count
+
     async def run(self):
         self.logger.info('%s worker has started', self.name)
-        engine = await models.get_aio_engine()
+        engine = await models.get_aio_engine(self.name)
+        messages = []
 
-        while True:
+        loop = asyncio.get_event_loop()
+
+        while not self.stopping:
             try:
                 self.logger.info('%s enter loop', self.name)
-                message = await self.queue.get()  # type: str
-                self.logger.info('%s got message', self.name)
-                if message is None:
-                    self.logger.info('%s no message, sleep', self.name)
-                    await asyncio.sleep(0.01)
+                messages = await self.fetch()
+                self.logger.info('%s got %s messages', self.name, len(messages))
+                if not messages:
                     continue
 
                 self.logger.info('%s enter handler', self.name)
-                await self.handler(engine, message)
+                started = loop.time()
+                await self.handle_batch(engine, [self.queue.decode(message) for message in messages])
+                self.record_latency(loop.time() - started, len(messages))
                 self.logger.info('%s done handler', self.name)
-                await self.queue.task_done()
-                await self.status.set('last', get_now_timestamp())
-                await self.status.set('size', await self.queue.qsize())
+                await self.done(messages)
+                messages = []
             except (KeyboardInterrupt, GeneratorExit, CancelledError) as e:  # cannot start any coroutine at this time!
                 msg = traceback.format_exc() + '\n%s worker exited: %s' % (self.name, e)
                 if not isinstance(e, GeneratorExit):
                     noblock(send_to_admin_channel(msg))
                 self.logger.error(msg)
-                noblock(self.queue.put(message))
-                self.start()  # TODO: may cause exit issue
-                report_exception()
+                if messages:
+                    noblock(self.requeue(messages))
+                report_exception()  # restarted by supervisor unless it is cancelled as well
                 break
             except SystemExit as e:
                 logger.warning('%s worker gracefully stopped', self.name)
                 break
             except Exception as e:
                 msg = traceback.format_exc() + '\n%s worker fails: %s' % (self.name, e)
-                await send_to_admin_channel(msg)
                 self.logger.error(msg)
-                await self.queue.put(message)
+                report_exception()
+                if messages:
+                    try:
+                        if len(messages) > 1 and not self.transient(e):
+                            failed = await self.isolate(engine, messages)
+                        else:
+                            failed = [(message, e) for message in messages]
+                        messages = [message for message, error in failed]
+                        by_error = OrderedDict()  # error -> messages failed with it, one retry call each
+                        for message, error in failed:
+                            by_error.setdefault(error, []).append(message)
+                        dead = 0
+                        for error, failed_messages in by_error.items():
+                            dead += await self.retry(failed_messages, error)
+                            for message in failed_messages:  # left ones are requeued if retry fails
+                                messages.remove(message)
+                    except Exception:
+                        self.logger.exception('%s retry failed', self.name)
+                        await self.requeue(messages)
+                        dead = 0
+                    if dead:  # admins are told only about messages given up
+                        await send_to_admin_channel(msg + '\n{} messages moved to dead letters'.format(dead))
+                messages = []
 
         self.logger.info('%s worker has stopped', self.name)
 
     def start(self, count: int=1):
-        for _ in range(count):
-            noblock(type(self)()())
+        """
+        Run `count` consumers, or the bounds in `WORKER_SCALING`, under the supervisor
+        """
+        if self.reliable:
+            noblock(self.queue.reclaim())
+        supervisor.add(type(self), *config.WORKER_SCALING.get(self.name, (count, count)))
+
+    async def handle_batch(self, engine, messages: list):
+        """
+        Handle messages fetched together, override it to share database and redis round trips in a batch
+        """
+        for message in messages:
+            await self.handler(engine, message)
 
-    async def handler(self, engine, message: str):
+    async def handler(self, engine, message):
         raise NotImplementedError
 
     @classmethod
@@ -160,69 +327,394 @@ class CoroutineWorker(metaclass=WorkProperties):
         except TypeError:
             last = get_now_timestamp()
             await cls.status.set('last', last)
-        return '{} worker: {} seconds ago, size {}\n'.format(
+        result = '{} worker: {} seconds ago, size {}\n'.format(
             cls.name, get_now_timestamp() - last, await cls.queue.qsize())
+        if isinstance(cls.queue, cache.LaneQueue):
+            result += ''.join('  {} lane: size {}\n'.format(lane, size)
+                              for lane, size in (await cls.queue.sizes()).items())
+        if isinstance(cls.queue, cache.RedisStreamQueue):
+            result += ''.join('  {}: {} pending\n'.format(consumer, count)
+                              for consumer, count in (await cls.queue.pending()).items())
+        return result
 
 
-class MessageInsertWorker(Worker):
-    name = 'insert'
+delayed = cache.RedisDelayedQueue('delayed_items')  # retries and delayed puts of all workers
 
-    def handler(self, session, message: str):
-        chat = models.ChatNew(**from_json(message))
-        session.add(chat)
-        session.commit()
-        if chat.text.startswith(config.OCR_HINT):
-            session.refresh(chat)
-            OcrWorker.queue.put(str(chat.id))
 
+class Supervisor:
+    """
+    Owns tasks of coroutine workers, and scales consumers of each worker class between its bounds every
+    `WORKER_SCALE_INTERVAL` seconds: up when the queue would take more than `WORKER_DRAIN_TARGET` seconds to drain
+    at the recent handling latency, down by one when it would take less than a quarter of that.
+    Consumers scaled down finish their current batch first.
+    """
+    def __init__(self):
+        self.bounds = {}  # worker class -> (min, max)
+        self.targets = {}  # worker class -> consumers wanted
+        self.tasks = {}  # worker class -> {task: worker}
+
+    def add(self, worker_class, minimum: int, maximum: int):
+        self.bounds[worker_class] = (minimum, maximum)
+        self.targets[worker_class] = max(self.targets.get(worker_class, 0), minimum)
+        self.tasks.setdefault(worker_class, {})
+        self.reconcile(worker_class)
+
+    def running(self, worker_class) -> List[CoroutineWorker]:
+        return [worker for worker in self.tasks[worker_class].values() if not worker.stopping]
+
+    def reconcile(self, worker_class):
+        tasks = self.tasks[worker_class]
+        for task in [task for task in tasks if task.done()]:  # stopped, or crashed and restarted below
+            del tasks[task]
+
+        running = self.running(worker_class)
+        target = self.targets[worker_class]
+        for _ in range(target - len(running)):
+            worker = worker_class()
+            tasks[asyncio.ensure_future(worker())] = worker
+        for worker in running[target:]:
+            worker.stopping = True
+
+    async def target(self, worker_class) -> int:
+        minimum, maximum = self.bounds[worker_class]
+        current = self.targets[worker_class]
+        if minimum == maximum:
+            return minimum
+
+        depth = await worker_class.queue.qsize()
+        if not worker_class.item_latency:  # nothing handled yet
+            return current
+        drain_time = depth * worker_class.item_latency / max(current, 1)  # scaled to zero with minimum 0
+        if drain_time > config.WORKER_DRAIN_TARGET:
+            wanted = math.ceil(depth * worker_class.item_latency / config.WORKER_DRAIN_TARGET)
+        elif drain_time < config.WORKER_DRAIN_TARGET / 4:
+            wanted = current - 1
+        else:
+            wanted = current
+        return min(max(wanted, minimum), maximum)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(config.WORKER_SCALE_INTERVAL)
+                for worker_class in list(self.tasks):
+                    self.targets[worker_class] = await self.target(worker_class)
+                    self.reconcile(worker_class)
+            except CancelledError:
+                break
+            except Exception:
+                logger.exception('scaling workers failed')
+                report_exception()
+
+    def stat(self) -> str:
+        return ''.join('{} consumers: {} running, {} draining, target {} ({} to {}), {:.3f}s per message\n'.format(
+            worker_class.name, len(self.running(worker_class)), len(tasks) - len(self.running(worker_class)),
+            self.targets[worker_class], *self.bounds[worker_class], worker_class.item_latency)
+            for worker_class, tasks in self.tasks.items())
 
-class MessageMarkWorker(Worker):
-    name = 'mark'
 
-    def handler(self, session, message: str):
-        request_changes = from_json(message)  # type: dict # {'chat_id': 114, 'message_id': 514}
-        count = session.query(models.ChatNew).filter(
-            models.ChatNew.chat_id == request_changes['chat_id'],
-            models.ChatNew.message_id == request_changes['message_id']
-        ).count()
-        if not count:
-            request_changes['tries'] = request_changes.get('tries', 0) + 1
-            if request_changes['tries'] < 2:
-                self.queue.put(to_json(request_changes))
+supervisor = Supervisor()
+
+
+class Stage:
+    """
+    Step of a pipeline, run by a fixed number of coroutines taking jobs from a bounded queue.
+    Errors of a job, OcrError included which is not an Exception, are passed to its caller, and a coroutine
+    failing otherwise is started again.
+    """
+    def __init__(self, name: str, handler: Callable[..., Awaitable]):
+        self.name = name
+        self.handler = handler
+        self.queue = None  # type: asyncio.Queue
+        self.concurrency = 0
+        self.count = 0
+        self.total_wait = 0.0  # seconds in queue
+        self.total_time = 0.0  # seconds in handler
+
+    def start(self, concurrency: int, queue_size: int):
+        if self.queue is not None:  # already started
             return
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.concurrency = concurrency
+        for _ in range(concurrency):
+            noblock(self.keep_running())
 
-        session.query(models.ChatNew).filter(
-            models.ChatNew.chat_id == request_changes['chat_id'],
-            models.ChatNew.message_id == request_changes['message_id']
-        ).update({
-            models.ChatNew.flag: models.ChatNew.flag.op('|')(models.ChatFlag.deleted)
-        }, synchronize_session='fetch')
+    async def keep_running(self):
+        while True:
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except BaseException:
+                logger.exception('%s stage failed, restarting', self.name)
+                report_exception()
+                await asyncio.sleep(1)
 
+    async def __call__(self, *args):
+        """
+        Wait for a free slot in the queue and then for the result
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        await self.queue.put((args, future, loop.time()))
+        return await future
 
-class OcrWorker(CoroutineWorker):
-    name = 'ocr'
-    cache = cache.RedisDailyDict('ocr')
-    lock = asyncio.Lock()
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            args, future, queued = await self.queue.get()
+            if future.done():  # caller gone
+                continue
+            started = loop.time()
+            try:
+                result = await self.handler(*args)
+            except asyncio.CancelledError:
+                if not future.done():  # the caller is not cancelled, it retries
+                    future.set_exception(RuntimeError('{} stage stopped'.format(self.name)))
+                raise
+            except BaseException as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finished = loop.time()
 
-    async def try_cache(self, path: str):
-        ts, file_id = path.split('-', maxsplit=1)
-        result = await self.cache[file_id]
-        if result == config.OCR_PROCESSING_HINT:
-            return True
-        elif result is None:
-            return False
+            self.count += 1
+            self.total_wait += started - queued
+            self.total_time += finished - started
+            await report_statistics(measurement='bot',
+                                    tags={'type': 'stage', 'stage': self.name},
+                                    fields={'count': 1,
+                                            'wait_ms': int((started - queued) * 1000),
+                                            'time_ms': int((finished - started) * 1000)})
+
+    def stat(self) -> str:
+        count = self.count or 1
+        return '  {}: {} running, {} queued, {} done, {:.3f}s wait, {:.3f}s run on average\n'.format(
+            self.name, self.concurrency, self.queue.qsize() if self.queue else 0, self.count,
+            self.total_wait / count, self.total_time / count)
+
+
+class Throttle:
+    """
+    AIMD rate of a bulk producer, shared by its coroutines. Every `THROTTLE_INTERVAL` seconds the rate is raised
+    by a twentieth of `max_rate` while the queues of `watched` workers are below their `THROTTLE_HIGH_WATER`,
+    halved when any is above, and the producer is paused while any is above twice the mark.
+    Producers writing by themselves `record` their write latency, the rate is halved as well while it is above
+    `latency_target`.
+    """
+    instances = []  # for stat
+
+    def __init__(self, name: str, max_rate: float, min_rate: float, watched: List[str], latency_target: float = 0):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = min_rate
+        self.watched = watched
+        self.latency_target = latency_target
+        self.latency = 0.0  # moving average of seconds per write
+        self.paused = False
+        self.checked = 0  # loop time of last adjustment
+        self.next_slot = 0  # loop time the next items may be produced
+        self.throttled = 0
+        self.sent = 0
+        self.instances.append(self)
+
+    @staticmethod
+    async def depth(worker_name: str) -> int:
+        queue = cache.queues[worker_name + '_queue']
+        if isinstance(queue, cache.LaneQueue):  # only the first lane has live items
+            queue = queue.first
+        return await queue.qsize()
+
+    async def adjust(self):
+        now = asyncio.get_event_loop().time()
+        if now - self.checked < config.THROTTLE_INTERVAL:
+            return
+        self.checked = now
+
+        over = {}  # worker name -> depth / high water mark
+        for name in self.watched:
+            mark = config.THROTTLE_HIGH_WATER[name]
+            depth = await self.depth(name)
+            if depth > mark:
+                over[name] = depth / mark
+        paused = any(ratio > 2 for ratio in over.values())
+        if self.latency_target and self.latency > self.latency_target:  # never paused on it, writes lower it
+            over['latency'] = self.latency / self.latency_target
+        if over:
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.throttled += 1
         else:
-            return result
+            self.rate = min(self.rate + self.max_rate / 20, self.max_rate)
+
+        if over or paused != self.paused:
+            await report_statistics(measurement='bot',
+                                    tags={'type': 'throttle', 'producer': self.name},
+                                    fields={'throttled': int(bool(over)), 'paused': int(paused)})
+        self.paused = paused
+
+    def record(self, seconds: float):
+        self.latency = 0.8 * self.latency + 0.2 * seconds if self.latency else seconds
+
+    async def wait(self, count: int = 1):
+        """
+        Wait until `count` items may be produced
+        """
+        await self.adjust()
+        while self.paused:
+            await asyncio.sleep(config.THROTTLE_INTERVAL)
+            await self.adjust()
+
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + count / self.rate
+        self.sent += count
+        await report_statistics(measurement='bot',
+                                tags={'type': 'throttle', 'producer': self.name},
+                                fields={'count': count})
+        await asyncio.sleep(slot - now)
+
+    @classmethod
+    def stat(cls) -> str:
+        return ''.join('{} producer: {:.1f}/s of {}/s{}, throttled {} times, {} sent\n'.format(
+            t.name, t.rate, t.max_rate, ' paused' if t.paused else '', t.throttled, t.sent) for t in cls.instances)
+
+
+# flags of deleted messages not inserted yet, applied by insert worker
+pending_flags = cache.RedisPendingFlags('pending_flags', ttl=config.PENDING_FLAGS_TTL)
+
+
+class MessageInsertWorker(CoroutineWorker):
+    """
+    Insert messages with multi-row INSERTs, batch grows with the queue size
+    """
+    name = 'insert'
+    codec = 'json'  # also consumed by go insert worker
+    batch_size = 1000
+    min_batch_size = 20
+    batch_linger = 0.05
+    max_attempts = 10  # outlives short database outages
+    inserted = cache.RedisExpiringSet('insert_set', expire=10)  # shared with go insert worker
+
+    def batch_limit(self) -> int:
+        return max(self.min_batch_size, min(self.batch_size, self.depth))
+
+    async def handle_batch(self, engine: aiomysql.sa.Engine, chats: List[dict]):
+        keys = [models.message_key(chat['chat_id'], chat['message_id']) for chat in chats]
+        seen = await self.inserted.touch_many(keys)
+        # another client of the same group may have seen the message, duplicates in batch are found as well
+        chats = [chat for chat, found in zip(chats, seen) if chat['flag'] != models.ChatFlag.new or not found]
+        if not chats:
+            return
 
-    async def remove_cache(self, path: str):
+        keys = [models.message_key(chat['chat_id'], chat['message_id']) for chat in chats]
+        flags = await pending_flags.pop_many(keys)
+        for chat, flag in zip(chats, flags):
+            chat['flag'] |= flag
+
+        try:
+            async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+                ids = await models.insert_messages(conn, chats)
+        except:
+            await self.inserted.discard_many([key for key, found in zip(keys, seen) if not found])
+            for flag in set(flags) - {0}:
+                await pending_flags.add([key for key, f in zip(keys, flags) if f == flag], flag)
+            raise
+
+        # flags added while inserting, see MessageMarkWorker
+        late = defaultdict(lambda: defaultdict(set))  # flag -> chat id -> message ids
+        for chat, flag in zip(chats, await pending_flags.pop_many(keys)):
+            if flag:
+                late[flag][chat['chat_id']].add(chat['message_id'])
+        if late:
+            async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+                for flag, groups in late.items():
+                    await models.mark_messages(conn, groups, flag)
+
+        await OcrWorker.queue.put_many([dict(id=record_id) for record_id, chat in zip(ids, chats)
+                                        if chat['text'].startswith(config.OCR_HINT)])
+
+    async def handler(self, engine: aiomysql.sa.Engine, chat: dict):
+        await self.handle_batch(engine, [chat])
+
+
+class MessageMarkWorker(CoroutineWorker):
+    """
+    Mark deleted messages, items are {'chat_id': 114, 'message_ids': [514, 1919]}
+    """
+    name = 'mark'
+    codec = 'json'  # also consumed by go mark worker
+    batch_size = 100
+    batch_linger = 0.1
+
+    async def handle_batch(self, engine: aiomysql.sa.Engine, items: List[dict]):
+        groups = defaultdict(set)  # chat_id -> message ids
+        for item in items:
+            message_ids = item.get('message_ids') or [item['message_id']]  # single id in old items
+            groups[item['chat_id']].update(message_ids)
+
+        async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+            missing = await models.mark_messages(conn, groups, models.ChatFlag.deleted)
+            if not missing:
+                return
+
+            # not inserted yet, leave it to insert worker.
+            # rows inserted before the flags are added are marked again here, after that insert worker sees them
+            await pending_flags.add([models.message_key(chat_id, message_id)
+                                     for chat_id, message_ids in missing.items()
+                                     for message_id in message_ids], models.ChatFlag.deleted)
+            still_missing = await models.mark_messages(conn, missing, models.ChatFlag.deleted)
+
+        await pending_flags.discard([models.message_key(chat_id, message_id)
+                                     for chat_id, message_ids in missing.items()
+                                     for message_id in message_ids - still_missing.get(chat_id, set())])
+
+    async def handler(self, engine: aiomysql.sa.Engine, item: dict):
+        await self.handle_batch(engine, [item])
+
+
+class OcrInterrupted(Exception):
+    """
+    Leader of a file stopped before its result, records joined it are retried
+    """
+
+
+class OcrWorker(CoroutineWorker):
+    name = 'ocr'
+    lanes = ('live', 'backlog')  # backlog is filled by scan_backlog with photos from history
+    backlog_throttle = Throttle('ocr_backlog', max_rate=config.OCR_BACKLOG_RATE, min_rate=0.1, watched=['ocr'])
+    processing_ttl = 300
+    stages = {}  # name -> Stage, download, upload, ocr and database write run with their own concurrency
+    single_flight = cache.RedisSingleFlight('ocr_lease', ttl=processing_ttl)  # by file id, across processes
+    cache = cache.RedisTTLCache('ocr_cache', ttl=config.OCR_CACHE_TTL)  # by file id and by content hash
+    flights = {}  # file key -> (future, record id -> text after ocr result), records of a file recognised in process
+
+    @staticmethod
+    def file_key(path: str) -> str:
         ts, file_id = path.split('-', maxsplit=1)
-        await self.cache.delitem(file_id)
+        return 'file-' + file_id
 
-    async def do_ocr(self, info: dict):
+    @staticmethod
+    def content_key(buffer: BytesIO) -> str:
+        return 'sha1-' + sha1(buffer.getbuffer()).hexdigest()
+
+    async def report_cache(self, kind: str):
+        await report_statistics(measurement='bot',
+                                tags={'type': 'ocr_cache'},
+                                fields={kind: 1})
+
+    @staticmethod
+    async def download(info: dict) -> Optional[BytesIO]:
+        """
+        :return: picture, None if not downloaded
+        """
         try:
             client = senders.clients[info['client']]
         except KeyError:
-            return config.OCR_HINT + '\n' + to_json(info)
+            return None
 
         buffer = BytesIO()
 
@@ -233,7 +725,7 @@ class OcrWorker(CoroutineWorker):
             except KeyError:
                 logger.warning('old style location object, cannot load it now')
                 # TODO: fetch the message again
-                return config.OCR_HINT + '\n' + to_json(info)
+                return None
             try:
                 del location_info['_']
             except KeyError:
@@ -246,7 +738,10 @@ class OcrWorker(CoroutineWorker):
                 report_exception()
                 logger.exception('ocr download got error')
                 location_info['file_reference'] = b64encode(location_info['file_reference']).decode('utf-8')
-                return config.OCR_HINT + '\n' + to_json(info)
+                return None
+            except FileReferenceExpiredError:
+                location_info['file_reference'] = b64encode(location_info['file_reference']).decode('utf-8')
+                raise
 
         elif isinstance(client, Bot):
             file_id = info['file_id']
@@ -255,34 +750,77 @@ class OcrWorker(CoroutineWorker):
                 await client.download_file_by_id(file_id, destination=buffer)
             except BadRequest as e:
                 logger.warning('bot file id not found: %s', e.text)
-                return config.OCR_HINT + '\n' + to_json(info)
+                return None
+
+        return buffer
 
+    @staticmethod
+    async def store(buffer: BytesIO, info: dict) -> str:
         buffer.seek(0)
-        full_path = await upload_pic(buffer, info['path'], info['filename'])
-        buffer.close()
+        try:
+            return await upload_pic(buffer, info['path'], info['filename'])
+        finally:
+            buffer.close()
+
+    @staticmethod
+    async def write(engine: aiomysql.sa.Engine, texts: dict):
+        async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+            await models.update_texts(conn, texts)
+
+    @staticmethod
+    async def refetch(info: dict, chat_id: int, message_id: int) -> Optional[dict]:
+        """
+        Fetch the message again for a fresh file reference
+
+        :return: info of the photo, None if the message or its photo is gone
+        """
+        client = senders.clients.get(info['client'])
+        if not isinstance(client, TelegramClient):
+            return None
+        message = await client.get_messages(chat_id, ids=message_id)
+        if message is None or not isinstance(message.media, MessageMediaPhoto):
+            return None
+        return from_json(await get_photo_address(client, message.media.photo, client_id=info['client']))
+
+    async def do_ocr(self, info: dict, chat_id: int, message_id: int):
+        try:
+            buffer = await self.stages['fetch'](info)
+        except FileReferenceExpiredError:  # photos from history mostly
+            fresh = await self.refetch(info, chat_id, message_id)
+            if fresh is None:  # deleted, failed for good
+                raise OcrError
+            info = fresh
+            buffer = await self.stages['fetch'](info)
+        if buffer is None:
+            return config.OCR_HINT + '\n' + to_json(info)
+
+        content_key = self.content_key(buffer)
+        cached = await self.cache.get(content_key)
+        if cached is not None:
+            buffer.close()
+            await self.report_cache('content_hit')
+            return cached
+
+        full_path = await self.stages['store'](buffer, info)
 
         await report_statistics(measurement='bot',
                                 tags={'master': info['client'],
                                       'type': 'ocr'},
                                 fields={'count': 1})
 
-        return await ocr(full_path)
+        result = await self.stages['recognise'](full_path)
+        await self.cache.set(result, content_key)
+        return result
 
-    async def handler(self, engine: aiomysql.sa.Engine, message: str):
-        ocr_request = from_json(message)  # type: dict # {'chat_id': 114, 'message_id': 514}
+    async def handler(self, engine: aiomysql.sa.Engine, ocr_request: dict):  # {'id': 1919}
 
         record_id = ocr_request['id']
 
         async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
             stmt = models.Core.ChatNew.select().where(models.ChatNew.id == record_id)
             records = await conn.execute(stmt)
-            if not records.rowcount:
-                logger.warning('ocr record %s found %s items (try %s), fail',
-                               record_id, records.rowcount, ocr_request.get('tries', 0))
-                ocr_request['tries'] = ocr_request.get('tries', 0) + 1
-                if ocr_request['tries'] < 1000:
-                    await OcrWorker.queue.put(to_json(ocr_request))
-                    await asyncio.sleep(0.1)
+            if not records.rowcount:  # rows are queued after committed
+                logger.warning('ocr record %s not found, skip', record_id)
                 return
             row = await records.fetchone()
             record_text = row.text
@@ -296,57 +834,189 @@ class OcrWorker(CoroutineWorker):
             return
         logger.info('ocr %s started', record_id)
 
-        # async with self.lock:
-        cached = await self.try_cache(info['filename'])
-
-        if isinstance(cached, str):
-            logger.info('ocr %s cached', record_id)
-            result = cached
-        elif cached is True:
-            logger.info('ocr %s need retry', record_id)
-            ocr_request['tries'] = ocr_request.get('tries', 0) + 1
-            if ocr_request['tries'] < 100:
-                await asyncio.sleep(0.1)
-                await self.queue.put(to_json(ocr_request))
-            else:
-                ocr_request['tries'] = 0
-                await self.remove_cache(info['filename'])
-                await self.queue.put(to_json(ocr_request))
+        file_key = self.file_key(info['filename'])
+        flight = self.flights.get(file_key)
+        if flight:  # written together with the record started first
+            logger.info('ocr %s joined', record_id)
+            flight[1][record_id] = hint, text
+            await flight[0]
             return
-        elif cached is False:
-            ts, file_id = info['filename'].split('-', maxsplit=1)
-            await self.cache.set(file_id, config.OCR_PROCESSING_HINT)
+
+        future = asyncio.get_event_loop().create_future()
+        records = {record_id: (hint, text)}
+        self.flights[file_key] = future, records
+        try:
+            result = await self.single_flight.run(file_key,
+                                                  lambda: self.compute(file_key, info, row.chatid, row.messageid),
+                                                  lambda: self.lookup(file_key))
+            del self.flights[file_key]  # records coming later find the result in cache
+            logger.info('ocr %s complete, writing %s records', record_id, len(records))
+            if result.startswith(config.OCR_HINT):  # not downloaded, records keep their hints to be tried later
+                info_text = result.split('\n', maxsplit=1)[1]
+                texts = {i: h + '\n' + info_text + '\n' + t for i, (h, t) in records.items()}
+            else:
+                texts = {i: result + '\n' + t for i, (h, t) in records.items()}
+            await self.stages['write'](engine, texts)
+            future.set_result(None)
+        except Exception as e:
+            if not isinstance(e, CancelledError):  # joined records would take it as their own cancellation
+                future.set_exception(e)
+                future.exception()  # retrieved, joined records are retried by their workers
+            raise
+        finally:
+            self.flights.pop(file_key, None)
+            if not future.done():  # leader cancelled
+                future.set_exception(OcrInterrupted(file_key))
+                future.exception()
+
+    async def lookup(self, file_key: str):
+        cached = await self.cache.get(file_key)
+        if cached is None or cached == config.OCR_PROCESSING_HINT:  # marker set by older workers
+            return None
+        await self.report_cache('file_hit')
+        return cached
+
+    async def compute(self, file_key: str, info: dict, chat_id: int, message_id: int) -> str:
+        await self.report_cache('miss')
+        try:
+            result = await self.do_ocr(info, chat_id, message_id)
+        except OcrError:
+            result = config.OCR_FAILED_HINT + '\n' + to_json(info)
+        if not result.startswith(config.OCR_HINT):  # not downloaded, try it later
+            await self.cache.set(result, file_key)
+        return result
+
+    @classmethod
+    async def scan_backlog(cls):
+        """
+        Feed history photos into backlog lane at `OCR_BACKLOG_RATE` per second, walking the ids in windows
+        from the one saved in status, while the lane has less than `OCR_BACKLOG_MAX_QUEUED` items
+        """
+        engine = await models.get_aio_engine('ocr_backlog')
+        backlog = cls.queue.lane('backlog')
+        last_id = int(await cls.status.get('backlog_last_id', 0))
+        while True:
             try:
-                result = await self.do_ocr(info)
-            except OcrError:
-                result = config.OCR_FAILED_HINT + '\n' + to_json(info)
-            await self.cache.set(file_id, result)
-            logger.info('ocr %s complete', record_id)
+                if await backlog.qsize() >= config.OCR_BACKLOG_MAX_QUEUED:
+                    await asyncio.sleep(config.OCR_BACKLOG_SCAN_INTERVAL)
+                    continue
 
-        async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
-            stmt = models.Core.ChatNew.\
-                update().\
-                where(models.ChatNew.id == record_id).\
-                values(text=result + '\n' + text)
-            await conn.execute(stmt)
-            await conn.execute('COMMIT;')
+                async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+                    max_id = await conn.scalar(sqlalchemy.select([sqlalchemy.func.max(models.ChatNew.id)]))
+                    stmt = sqlalchemy.select([models.ChatNew.id]).where(sqlalchemy.and_(
+                        models.ChatNew.id > last_id,
+                        models.ChatNew.id <= last_id + config.OCR_BACKLOG_SCAN_WINDOW,
+                        models.ChatNew.text.startswith(config.OCR_HISTORY_HINT),
+                    )).order_by(models.ChatNew.id).limit(config.OCR_BACKLOG_PAGE_SIZE)
+                    ids = [row[0] for row in await (await conn.execute(stmt)).fetchall()]
+
+                if len(ids) == config.OCR_BACKLOG_PAGE_SIZE:
+                    last_id = ids[-1]
+                else:  # window scanned
+                    last_id = min(last_id + config.OCR_BACKLOG_SCAN_WINDOW, max_id or 0)
+                await backlog.put_many([dict(id=record_id) for record_id in ids])
+                await cls.status.set('backlog_last_id', last_id)
+
+                if ids:
+                    await cls.backlog_throttle.wait(len(ids))
+                elif last_id >= (max_id or 0):  # all scanned, wait for more history
+                    await asyncio.sleep(config.OCR_BACKLOG_SCAN_INTERVAL)
+            except CancelledError:
+                break
+            except Exception:
+                logger.exception('ocr backlog scan failed')
+                report_exception()
+                await asyncio.sleep(config.OCR_BACKLOG_SCAN_INTERVAL)
 
+    def start(self, count: int=1):
+        if not self.stages:  # first start in process
+            if config.OCR_BACKLOG_RATE:
+                noblock(self.scan_backlog())
+            OcrWorker.stages = {
+                'fetch': Stage('ocr_fetch', self.download),
+                'store': Stage('ocr_store', self.store),
+                'recognise': Stage('ocr_recognise', ocr),
+                'write': Stage('ocr_write', self.write),
+            }
+        for name, stage in self.stages.items():
+            stage.start(config.OCR_STAGE_CONCURRENCY[name], config.OCR_STAGE_QUEUE_SIZE)
+        super().start(count)
 
-class EntityUpdateWorker(Worker):
+    @classmethod
+    async def stat(cls):
+        basic = await super().stat()
+        return basic + 'ocr cache: {} hits, {} misses, {} files in progress\n'.format(
+            cls.cache.hits, cls.cache.misses, len(cls.flights)) + \
+            ''.join(stage.stat() for stage in cls.stages.values())
+
+
+class EntityUpdateWorker(CoroutineWorker):
+    """
+    Upsert users and groups in batches, entities unchanged since written by this process are dropped before any query.
+    Other processes may change them meanwhile, so a fingerprint is trusted for `ENTITY_FINGERPRINTS_TTL` seconds.
+    """
     name = 'entity'
+    codec = 'json'  # also consumed by go entity worker
+    batch_size = 500
+    batch_linger = 0.1
+    fingerprint_fields = {
+        'user': ('first_name', 'last_name', 'username'),  # language is filled once, not tracked
+        'group': ('name', 'link'),
+    }
+    fingerprints = OrderedDict()  # (type, id) -> (hash of fields last written, written at), least recently seen first
+    skipped = 0
+    written = 0
 
-    def handler(self, session, message: str):
-        info = from_json(message)
-        entity_type = info['type']
-        del info['type']
-        if entity_type == 'user':
-            models.update_user(session=session, **info['user'])
-        if entity_type == 'group':
-            models.update_group(session=session, **info['group'])
+    @classmethod
+    def fingerprint(cls, item: dict) -> tuple:
+        entity_type = item['type']
+        entity = item[entity_type]
+        entity_id = entity['user_id'] if entity_type == 'user' else entity['chat_id']
+        return (entity_type, entity_id), hash(tuple(entity.get(field) for field in cls.fingerprint_fields[entity_type]))
+
+    async def handle_batch(self, engine: aiomysql.sa.Engine, items: List[dict]):
+        fingerprints = {}
+        now = get_now_timestamp()
+        for item in items:
+            key, value = self.fingerprint(item)
+            last_value, written_at = self.fingerprints.get(key, (None, 0))
+            if last_value == value and now - written_at < config.ENTITY_FINGERPRINTS_TTL:
+                self.fingerprints.move_to_end(key)
+                EntityUpdateWorker.skipped += 1
+                continue
+            fingerprints[key] = value, item[item['type']]
+        if not fingerprints:
+            return
+
+        async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+            users = [entity for (entity_type, _), (_, entity) in fingerprints.items() if entity_type == 'user']
+            groups = [entity for (entity_type, _), (_, entity) in fingerprints.items() if entity_type == 'group']
+            EntityUpdateWorker.written += await models.upsert_users(conn, users)
+            EntityUpdateWorker.written += await models.upsert_groups(conn, groups)
+
+        for key, (value, _) in fingerprints.items():
+            self.fingerprints[key] = value, now
+            self.fingerprints.move_to_end(key)
+        while len(self.fingerprints) > config.ENTITY_FINGERPRINTS_SIZE:
+            self.fingerprints.popitem(last=False)
+
+    async def handler(self, engine: aiomysql.sa.Engine, item: dict):
+        await self.handle_batch(engine, [item])
+
+    @classmethod
+    async def stat(cls):
+        return await super().stat() + '  {} skipped, {} written\n'.format(cls.skipped, cls.written)
 
 
 class FindLinkWorker(CoroutineWorker):
     name = 'find_link'
+    codec = 'raw'
+    batch_size = 100
+    batch_linger = 0.1
+
+    async def handle_batch(self, engine, messages: List[str]):
+        # links are deduplicated across the whole batch
+        await self.handler(engine, '\n'.join(messages))
 
     async def handler(self, engine, message):
         from discover import find_link_to_join
@@ -354,145 +1024,244 @@ class FindLinkWorker(CoroutineWorker):
 
 
 class FetchHistoryWorker(CoroutineWorker):
+    """
+    Backfill history of groups. A group is split into message id ranges fetched concurrently, each by any client
+    in the group that is not waiting for a flood wait to end, preferring the master of the group.
+    """
     name = 'history'
+    # pages are written by history workers, live queues tell how busy the database is
+    throttle = Throttle('history', max_rate=config.HISTORY_MAX_RATE, min_rate=config.HISTORY_MIN_RATE,
+                        watched=['insert', 'entity'], latency_target=config.HISTORY_WRITE_LATENCY)
+    deadlines = {}  # client id -> loop time its flood wait ends
+    non_members = defaultdict(set)  # group id -> ids of clients cannot read it
+    progress = {}  # range key -> {'gid', 'min_id', 'start_id', 'current', 'started'}, ranges fetching in process
+
+    def __init__(self):
+        super().__init__()
+        self.page_delay = 0  # seconds between pages, raised by flood waits
 
-    async def handler(self, engine: aiomysql.sa.Engine, message: str):
-        info = from_json(message)
-        gid = info['gid']
+    @staticmethod
+    def range_key(gid: int, min_id: int) -> str:
+        return '{}:{}'.format(gid, min_id)
 
+    async def handler(self, engine: aiomysql.sa.Engine, info: dict):
+        if 'max_id' in info:
+            await self.fetch_range(engine, info)
+        else:
+            await self.split(engine, info['gid'])
+
+    async def split(self, engine: aiomysql.sa.Engine, gid: int):
+        """
+        Queue ranges of ids before the first message seen in group, once at a time.
+        `{gid}:ranges` counts ranges left, `group_sync.min_message_id` is contiguous only after all of them are done,
+        so the group is not split again before that, dead-lettered ranges have to be replayed.
+        """
         async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
-            stmt = sqlalchemy.select([
-                models.Group.gid,
-                models.Group.master,
-                models.Group.name,
-                models.Group.link,
-                sqlalchemy.sql.func.min(models.ChatNew.message_id).label('min_message_id')
-            ]).where(
-                sqlalchemy.and_(models.Group.gid == gid, models.Group.gid == models.ChatNew.chat_id)
-            ).group_by(models.Group.gid)
-            records = await conn.execute(stmt)
-            if not records.rowcount:
+            records = await conn.execute(models.Core.Group.select().where(models.Group.gid == gid))
+            group = await records.fetchone()
+            sync = await models.get_sync_state(conn, gid)
+            if group is None or sync is None:
                 await send_to_admin_channel('fetch: No message id detected or group not joined ever before for group'
                                             f'{gid}')
                 return
-            row = await records.fetchone()
-
-        master = row.master
-        self.master = row.master
-        name = row.name
-        link = row.link
-        self.first = row.min_message_id
-
-        print(senders.clients.keys(), 'master is', repr(master))
-        client = senders.clients.get(master, None)
+            await models.set_backfill_state(conn, gid)
 
-        if isinstance(client, Bot):
-            await send_to_admin_channel(f'Group {name}(@{link}) is managed by a bot ({master}), '
+        if isinstance(senders.clients.get(group.master), Bot):
+            await send_to_admin_channel(f'Group {group.name}(@{group.link}) is managed by a bot ({group.master}), '
                                         f'cannot fetch information')
             return
-        # profile = Profile()
-        # profile.enable()
+
+        # both ends are exclusive, so a range ends one id below the max_id of the next
+        ranges = [dict(gid=gid, master=group.master, min_id=max(max_id - config.HISTORY_RANGE_SIZE - 1, 0),
+                       max_id=max_id)
+                  for max_id in range(sync.min_message_id, 0, -config.HISTORY_RANGE_SIZE)]
+        if not ranges:
+            return
+        if not await self.status.setnx('{}:ranges'.format(gid), len(ranges)):
+            left = await self.status.get('{}:ranges'.format(gid), 0)
+            await send_to_admin_channel(f'fetch: group {gid} is being fetched, {left} ranges left, '
+                                        f'replay its dead letters if it is stuck')
+            return
+        await self.queue.put_many(ranges)
+
+    def candidates(self, gid: int, master: int) -> List[int]:
+        """
+        :return: ids of clients may read the group, master first
+        """
+        others = [client_id for client_id in senders.clients if client_id != master]
+        return [client_id for client_id in [master] + others
+                if isinstance(senders.clients.get(client_id), TelegramClient)
+                and client_id not in self.non_members[gid]]
+
+    async def pick_client(self, gid: int, master: int) -> Optional[int]:
+        """
+        Wait until a client of the group is not in flood wait
+
+        :return: client id, None if no client can read the group
+        """
+        loop = asyncio.get_event_loop()
         while True:
-            try:
-                prev = self.first
-                await self.fetch(client, gid)
-                if prev == self.first:  # no new messages
-                    await self.status.delitem(gid)
-                    await send_to_admin_channel(f'Group {name}(@{link}) all fetched by {master}, last message id is {prev}')
+            candidates = self.candidates(gid, master)
+            if not candidates:
+                return None
+            now = loop.time()
+            for client_id in candidates:
+                if self.deadlines.get(client_id, 0) <= now:
+                    return client_id
+            await asyncio.sleep(min(self.deadlines[client_id] for client_id in candidates) - now)
+
+    async def fetch_range(self, engine: aiomysql.sa.Engine, info: dict):
+        """
+        Fetch messages with min_id < id < max_id, from the checkpoint of the range if any
+        """
+        gid, master, min_id = info['gid'], info['master'], info['min_id']
+        key = self.range_key(gid, min_id)
+        current = min(int(await self.status.get(key, info['max_id'])), info['max_id'])
+        self.progress[key] = dict(gid=gid, min_id=min_id, start_id=current, current=current,
+                                  started=asyncio.get_event_loop().time())
+        try:
+            while True:
+                client_id = await self.pick_client(gid, master)
+                if client_id is None:
+                    await send_to_admin_channel(f'fetch worker failed: no client can read group {gid}, '
+                                                f'ids {min_id} to {current} left')
+                    return
+                client = senders.clients[client_id]
+                try:
+                    messages = await client.get_messages(entity=gid,
+                                                         limit=config.HISTORY_PAGE_SIZE,
+                                                         offset_id=current,
+                                                         min_id=min_id)  # type: List[Message]
+                except FloodWaitError as e:
+                    self.deadlines[client_id] = asyncio.get_event_loop().time() + self.flood_wait(e)
+                    continue
+                except (ChannelPrivateError, ValueError):  # kicked, or group not known by the client
+                    self.non_members[gid].add(client_id)
+                    continue
+                except RpcCallFailError:
+                    continue
 
+                if not messages:
                     break
-            except FloodWaitError as e:
-                await asyncio.sleep(e.seconds + 1)
-            except ChannelPrivateError as e:
-                await send_to_admin_channel(f'fetch worker failed: group {gid} (managed by {master}) kicked us')
-                break
-            except KeyboardInterrupt:
-                break
-            except RpcCallFailError:
+                current = messages[-1].id  # newest first
+                await self.save_page(engine, client, client_id, key, gid, messages)
+                self.progress[key]['current'] = current
+                self.page_delay *= config.HISTORY_PAGE_DELAY_DECAY
+                await asyncio.sleep(self.page_delay)
+                await self.throttle.wait(len(messages))
+        finally:
+            del self.progress[key]
+
+        await self.status.delitem(key)
+        await self.status.incrby('{}:ranges'.format(gid), -1)
+        if int(await self.status.get('{}:ranges'.format(gid), 0)) <= 0:
+            await self.status.delitem('{}:ranges'.format(gid))
+            async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+                await models.set_backfill_state(conn, gid, complete=True)
+            await send_to_admin_channel(f'Group {gid} all fetched')
+
+    def flood_wait(self, e: FloodWaitError) -> int:
+        """
+        Slow down following pages after a flood wait
+
+        :return: seconds to wait now
+        """
+        self.page_delay = min(max(self.page_delay * 2, config.HISTORY_PAGE_DELAY_MIN), config.HISTORY_PAGE_DELAY_MAX)
+        return e.seconds + 1
+
+    async def save_page(self, engine: aiomysql.sa.Engine, client, client_id: int, key: str, gid: int,
+                        messages: List[Message]):
+        """
+        Insert messages of a page at once, and their senders as one entity batch.
+        Older than any message stored, they skip deduplication, pending flags and OCR queueing of insert worker.
+        """
+        chats = []
+        users = {}  # user id -> user in queue format, deduplicated in page
+        for msg in messages:
+            if isinstance(msg, MessageService) or msg.date is None:
                 continue
-            except:
-                await send_to_admin_channel(traceback.format_exc() + '\nfetch worker unknown exception')
-
-        # profile.disable()
-        # profile.dump_stats('normal.profile')
-
-    async def fetch(self, client, gid):
-        async for msg in client.iter_messages(entity=gid,
-                                              limit=None,
-                                              offset_id=self.first,
-                                              max_id=self.first,
-                                              wait_time=0
-                                              ):  # type: Message
-            self.first = msg.id
-            before = datetime.now().timestamp()
-            await self.save(client, gid, msg)
-            after = datetime.now().timestamp()
-            await asyncio.sleep(0.01 - (after - before))
-
-    async def save(self, client, gid, msg: Message):
-        if True:
-            if isinstance(msg, MessageService):
-                return
             text = markdown.unparse(msg.message, msg.entities)
 
             if isinstance(msg.media, MessageMediaPhoto):
-                result = await get_photo_address(client, msg.media.photo)
+                result = await get_photo_address(client, msg.media.photo, client_id=client_id)
                 text = config.OCR_HISTORY_HINT + '\n' + result + '\n' + text
 
-            await report_statistics(measurement='bot',
-                                    tags={'master': self.master,
-                                          'type': 'history'},
-                                    fields={'count': 1})
+            if text:
+                chats.append(dict(chat_id=gid,
+                                  message_id=msg.id,
+                                  user_id=msg.from_id,
+                                  text=text,
+                                  date=int(msg.date.replace(tzinfo=timezone.utc).timestamp()),
+                                  flag=models.ChatFlag.new))
+            for sender in (msg.sender if msg.input_sender is not None else None, msg.fwd_from):
+                if isinstance(sender, User):
+                    users[sender.id] = dict(user_id=sender.id,
+                                            first_name=sender.first_name,
+                                            last_name=sender.last_name,
+                                            username=sender.username,
+                                            lang_code=sender.lang_code)
+
+        started = asyncio.get_event_loop().time()
+        async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+            await models.insert_messages(conn, chats)
+            await models.upsert_users(conn, list(users.values()))
+            await models.set_backfill_state(conn, gid)
+        self.throttle.record(asyncio.get_event_loop().time() - started)
 
-            await models.insert_message_local_timezone(gid, msg.id, msg.from_id, text, msg.date)
-            if msg.input_sender is not None:  # type: User
-                await models.update_user_real(
-                    msg.sender.id,
-                    msg.sender.first_name,
-                    msg.sender.last_name,
-                    msg.sender.username,
-                    msg.sender.lang_code)
-            if isinstance(msg.fwd_from, User):
-                await models.update_user_real(
-                    msg.fwd_from.id,
-                    msg.fwd_from.first_name,
-                    msg.fwd_from.last_name,
-                    msg.fwd_from.username,
-                    msg.fwd_from.lang_code)
-
-            await self.status.set('last', get_now_timestamp())
-            await self.status.set(str(gid), msg.id)
+        await report_statistics(measurement='bot',
+                                tags={'master': client_id,
+                                      'type': 'history'},
+                                fields={'count': len(chats)})
+        await self.status.update({'last': get_now_timestamp(), key: messages[-1].id})
 
     @classmethod
     async def stat(cls):
-        basic = await super().stat()
-        return basic + await cls.status.repr() + '\n'
+        now = asyncio.get_event_loop().time()
+        groups = defaultdict(lambda: [0, 0, 0])  # group id -> [ranges, ids fetched, ids left]
+        elapsed = {}  # group id -> seconds since its oldest range started
+        for p in cls.progress.values():
+            group = groups[p['gid']]
+            group[0] += 1
+            group[1] += p['start_id'] - p['current']
+            group[2] += p['current'] - p['min_id']
+            elapsed[p['gid']] = max(elapsed.get(p['gid'], 0), now - p['started'])
+
+        result = await super().stat()
+        result += '  {} clients in flood wait\n'.format(sum(deadline > now for deadline in cls.deadlines.values()))
+        for gid, (ranges, fetched, left) in groups.items():
+            rate = fetched / elapsed[gid] if elapsed[gid] else 0
+            eta = '{:.0f}s'.format(left / rate) if rate else '?'
+            result += '  group {}: {} ranges, {:.1f} ids/s, {} ids left, eta {}\n'.format(gid, ranges, rate, left, eta)
+        return result
 
 
 class InviteWorker(CoroutineWorker):
     name = 'invite'
+    batch_size = 100
+    batch_linger = 0.5
 
-    async def handler(self, engine: aiomysql.sa.Engine, message: str):
-        info = from_json(message)
-
+    async def handle_batch(self, engine: aiomysql.sa.Engine, infos: List[dict]):
         await report_statistics(measurement='bot',
                                 tags={'type': 'invite'},
-                                fields={'count': 1})
+                                fields={'count': len(infos)})
 
         async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
-            stmt = models.Core.GroupInvite.insert().values(**info)
-            await conn.execute(stmt)
+            # the same invite seen again keeps its first row, other errors are raised as before
+            stmt = mysql.insert(models.Core.GroupInvite).values(infos)
+            await conn.execute(stmt.on_duplicate_key_update(invite=models.Core.GroupInvite.c.invite))
             await conn.execute('COMMIT')
 
+    async def handler(self, engine: aiomysql.sa.Engine, info: dict):
+        await self.handle_batch(engine, [info])
+
 
 class JoinGroupWorker(CoroutineWorker):
     name = 'join'
     wait_until = 0
 
-    async def handler(self, engine: aiomysql.sa.Engine, message: str):
+    async def handler(self, engine: aiomysql.sa.Engine, info: dict):
         self.wait_until = 0
 
-        info = from_json(message)
         link_type = info['link_type']
         link = info['link']
         group_type = info['group_type']
@@ -503,10 +1272,9 @@ class JoinGroupWorker(CoroutineWorker):
                 group = await senders.invoker.get_input_entity(link)  # type: InputChannel
             except FloodWaitError as e:
                 logger.warning('Get group via username flooded. %r', e)
-                await self.queue.put(message)
+                await delayed.put(self.queue.name, info, e.seconds)
                 return
 
-        global_count = cache.RedisDict('global_count')
         try:
             if link_type == 'public':
                 await senders.invoker(JoinChannelRequest(group))
@@ -530,7 +1298,7 @@ class JoinGroupWorker(CoroutineWorker):
                 await global_count.set('full', '1')
             return
         except FloodWaitError as e:
-            await self.queue.put(message)
+            await delayed.put(self.queue.name, info, e.seconds)
             self.wait_until = get_now_timestamp() + e.seconds
             await send_to_admin_channel(f'Join group triggered flood, sleeping for {e.seconds} seconds.')
             await asyncio.sleep(e.seconds)
@@ -540,6 +1308,7 @@ class JoinGroupWorker(CoroutineWorker):
 class ReportStatisticsWorker(CoroutineWorker):
     name = 'report'
     global_statistics = cache.RedisDict('global_statistics')
+    pending = deque(maxlen=config.INFLUXDB_BUFFER_SIZE)  # points failed to write, oldest dropped first
 
     async def run(self):
         logger.info('%s worker has started', self.name)
@@ -563,26 +1332,77 @@ class ReportStatisticsWorker(CoroutineWorker):
                 continue
 
     async def report(self):
-        for k, v in await self.global_statistics.items():
-            noblock(self.global_statistics.set(k, 0))
-
+        now = datetime.now()
+        for k, v in await self.global_statistics.pop_all():
             measurement, tags_ = k.split('|', maxsplit=1)
             tags = from_json(tags_)
             key = tags['key']
             del tags['key']
 
-            noblock(self.influxdb_client.write(dict(
-                time=datetime.now(),
+            self.pending.append(dict(
+                time=now,
                 measurement=measurement,
                 tags=tags,
                 fields={key: v}
-            )))
+            ))
+
+        if not self.pending:
+            return
+        points = list(self.pending)
+        try:
+            await self.influxdb_client.write(points)
+        except Exception as e:
+            logger.warning('write %s points to influxdb failed, %s points buffered: %r',
+                           len(points), len(self.pending), e)
+            return
+        self.pending.clear()
+
+    @classmethod
+    async def stat(cls):
+        basic = await super().stat()
+        return basic + 'report buffered {} points\n'.format(len(cls.pending))
 
 
 async def history_add_handler(bot, update, text):
-    content = to_json(dict(gid=int(text)))
+    content = dict(gid=int(text))
     await FetchHistoryWorker.queue.put(content)
-    return 'Added <pre>{}</pre> into history fetching queue'.format(content)
+    return 'Added <pre>{}</pre> into history fetching queue'.format(to_json(content))
+
+
+async def history_gaps_handler(bot, update, text):
+    engine = await models.get_aio_engine('admin')
+    async with engine.acquire() as conn:  # type: aiomysql.sa.SAConnection
+        rows = await models.incomplete_groups(conn, int(text or 20))
+    return 'Groups with history not all fetched:\n' + ''.join(
+        '<pre>{}</pre> ids {} to {}, last fetched {}\n'.format(
+            row.gid, row.min_message_id, row.max_message_id,
+            datetime.fromtimestamp(row.backfill_time) if row.backfill_time else 'never')
+        for row in rows)
+
+
+def find_worker(name: str):
+    for worker_class in supervisor.tasks:
+        if worker_class.name == name:
+            return worker_class
+    raise ValueError('worker {} not found'.format(name))
+
+
+async def dead_letters_handler(bot, update, text):
+    name, *rest = text.split()
+    worker_class = find_worker(name)
+    dead = cache.RedisDeadLetters(worker_class.queue.name)
+    entries = await dead.peek(int(rest[0]) if rest else 5)
+    return '{} dead letters of {}:\n'.format(await dead.qsize(), name) + ''.join(
+        '<pre>{}</pre> {} attempts, {}, {}\n'.format(tg_html_entity(repr(entry['v'])), entry['attempts'],
+                                                     tg_html_entity(entry['error']), datetime.fromtimestamp(entry['time']))
+        for entry in entries)
+
+
+async def replay_dead_letters_handler(bot, update, text):
+    name, *rest = text.split()
+    worker_class = find_worker(name)
+    count = await cache.RedisDeadLetters(worker_class.queue.name).replay(int(rest[0]) if rest else 1)
+    return 'Replayed {} dead letters of {}'.format(count, name)
 
 
 async def workers_handler(bot, update, text):
@@ -594,4 +1414,9 @@ async def workers_handler(bot, update, text):
            await InviteWorker.stat() + \
            await JoinGroupWorker.stat() + \
            await FetchHistoryWorker.stat() + \
-           await ReportStatisticsWorker.stat()
+           await ReportStatisticsWorker.stat() + \
+           supervisor.stat() + \
+           'delayed items: {}\n'.format(await delayed.qsize()) + \
+           Throttle.stat() + \
+           models.pool_stat() + \
+           await cache.RedisExpiringSet.stat()